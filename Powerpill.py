@@ -26,14 +26,34 @@ internal support for Rsync, Reflector and Pacserve.
 # I intend to clean it up when I have the time and proper motivation.
 
 import collections
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
+import errno
+import functools
 import glob
+import hashlib
+import http.server
+import io
 import json
 import logging
 import os
+import pickle
 import platform
+import re
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import urllib.parse
+import urllib.request
 
 import pyalpm
 
@@ -51,14 +71,30 @@ except ImportError:
         '''
         return None
 
-try:
-    import Reflector
-    OFFICIAL_REPOSITORIES = Reflector.MirrorStatus.REPOSITORIES
-except ImportError:
-    OFFICIAL_REPOSITORIES = tuple()
 
 # --------------------------------- Globals ---------------------------------- #
 
+# Repositories that are available on the servers in rsync/servers. Other
+# repositories require servers in rsync/repos/<name>/servers.
+OFFICIAL_REPOSITORIES = (
+    'community',
+    'community-staging',
+    'community-testing',
+    'core',
+    'core-staging',
+    'core-testing',
+    'extra',
+    'extra-staging',
+    'extra-testing',
+    'gnome-unstable',
+    'kde-unstable',
+    'multilib',
+    'multilib-staging',
+    'multilib-testing',
+    'staging',
+    'testing',
+)
+
 DB_EXT = '.db'
 FILES_EXT = '.files'
 SIG_EXT = '.sig'
@@ -68,8 +104,76 @@ CACHE_LOCK_FILE = 'cache.lck'
 CACHE_LOCK_NAME = 'cache'
 
 POWERPILL_CONFIG = '/etc/powerpill/powerpill.json'
+POWERPILL_CACHE_DIR = '/var/cache/powerpill'
 ARIA2_EXT = '.aria2'
 
+PACMAN_CONFIG_SNAPSHOT_FILE = 'pacman-conf.pickle'
+RESOLUTION_CACHE_FILE = 'resolution.json'
+ARIA2_TUNING_FILE = 'aria2-tuning.json'
+SIGNATURES_FILE = 'signatures.json'
+THROUGHPUT_FILE = 'throughput.json'
+# The weight of new samples in the moving average of the throughput.
+THROUGHPUT_WEIGHT = 0.3
+# Transfers of fewer bytes are too short to measure the throughput.
+THROUGHPUT_MIN_BYTES = 0x100000
+
+# The round-trip time in seconds to assume if it has never been measured.
+DEFAULT_RTT = 0.05
+# The timeout in seconds for measuring the round-trip time.
+RTT_TIMEOUT = 1
+# The maximum number of mirrors to probe when measuring the round-trip time.
+RTT_PROBES = 2
+# The maximum number of resolution results to keep in the cache.
+RESOLUTION_CACHE_SIZE = 8
+
+# Package file names: name-pkgver-pkgrel-arch.pkg.tar[.ext]
+PKG_FILENAME_REGEX = re.compile(
+    r'^(?P<name>.+)-(?P<version>[^-]+-[^-]+)-(?P<arch>[^-]+)\.pkg\.tar(?:\.[^.]+)?$'
+)
+
+# Values of powerpill/download order.
+DOWNLOAD_ORDERS = (
+    'default',
+    'smallest first',
+    'largest first',
+    'dependencies',
+)
+
+# The datagram broadcast by Powerpill to discover peers on the local network.
+PEER_DISCOVERY_MESSAGE = b'powerpill-peer-discovery'
+
+# The name of the manifest at the start of offline bundles.
+BUNDLE_MANIFEST = 'manifest.json'
+BUNDLE_VERSION = 1
+# The sections of offline bundles, in the order in which they are written.
+BUNDLE_SECTIONS = ('packages', 'sync')
+# Chunked bundles are written to <path>.000, <path>.001, etc.
+BUNDLE_CHUNK_FORMAT = '{}.{:03d}'
+# The size of the blocks in which bundle files are extracted and hashed.
+BUNDLE_BLOCK_SIZE = 0x100000
+
+# The size of the blocks in which staged files are copied to another filesystem.
+STAGING_BLOCK_SIZE = 0x4000000
+# The fraction of the staging directory's free space that is used as the
+# staging budget if none is configured. The staging directory may be a tmpfs.
+STAGING_BUDGET_FRACTION = 0.25
+
+# The interval in seconds at which the peer server verifies the cache.
+PEER_VERIFICATION_INTERVAL = 10
+# The maximum size in bytes of the body of a peer query.
+PEER_QUERY_MAX_BYTES = 0x400000
+
+# Results of signature verification.
+SIGNATURE_VALID = 'valid'
+SIGNATURE_BAD = 'bad'
+SIGNATURE_UNKNOWN = 'unknown'
+
+# The number of files removed by each task when cleaning.
+CLEAN_BATCH_SIZE = 256
+
+# The interval in seconds at which supervised processes are polled.
+SUPERVISOR_POLL_INTERVAL = 0.2
+
 # See the aria2c manual page for details.
 ARIA2_DOWNLOAD_ERROR_EXIT_CODES = (0, 2, 3, 4, 5)
 # See the rsync manual page for details.
@@ -130,8 +234,19 @@ RECOGNIZED_PACMAN_SHORT_OPTIONS = dict(
     ('-' + x, '--' + y) for x, y in zip('SFyuwqv', RECOGNIZED_PACMAN_OPTIONS)
 )
 
+# Targets are passed to Pacman via stdin instead of the command line if their
+# combined size in bytes exceeds this limit.
+PACMAN_ARGV_TARGETS_MAX = 0x10000
+
 POWERPILL_PARAM_OPTS = set((
     '--powerpill-config',
+    '--powerpill-targets-file',
+    '--powerpill-root',
+    '--powerpill-jobs',
+    '--powerpill-profile',
+    '--powerpill-export',
+    '--powerpill-export-base',
+    '--powerpill-import',
 ))
 
 
@@ -148,6 +263,41 @@ def expand_recognized_pacman_short_options(args):
             yield arg
 
 
+def iter_targets(handle, comments=False):
+    '''
+    Iterate over whitespace-separated targets read line by line from a file
+    handle. If comments is True, everything after "#" on a line is ignored.
+    '''
+    for line in handle:
+        if comments:
+            line = line.split('#', 1)[0]
+        yield from line.split()
+
+
+def read_stdin_targets(comments=False):
+    '''
+    Iterate over the targets read from stdin. Like Pacman, refuse to read them
+    from a terminal instead of waiting for input.
+    '''
+    if sys.stdin.isatty():
+        raise ArgumentError('argument "-" specified without input on stdin')
+    yield from iter_targets(sys.stdin, comments=comments)
+
+
+def read_targets_file(path):
+    '''
+    Iterate over the targets in a file. "-" refers to stdin.
+    '''
+    if path == '-':
+        yield from read_stdin_targets(comments=True)
+        return
+    try:
+        with open(path) as handle:
+            yield from iter_targets(handle, comments=True)
+    except OSError as err:
+        raise ArgumentError('failed to read targets from {} [{}]'.format(path, err)) from err
+
+
 def parse_args(args=None):  # pylint: disable=too-many-statements,too-many-branches
     '''
     Parse (Pacman) command-line arguments and extract those that control
@@ -167,30 +317,50 @@ def parse_args(args=None):  # pylint: disable=too-many-statements,too-many-branc
         'options': list(),
         'args': list(),
         'other_operation': False,
+        'powerpill_roots': list(),
+        'powerpill_serve': False,
+        'powerpill_plan': False,
+        'powerpill_profile': None,
+        'powerpill_export': None,
+        'powerpill_export_base': None,
+        'powerpill_import': None,
+        'powerpill_jobs': None,
         'raw': list(XCGF.filter_arguments(args, remove={
             '--powerpill-clean': 0,
             '--powerpill-config': 1,
+            '--powerpill-serve': 0,
+            '--powerpill-plan': 0,
+            '--powerpill-root': 1,
+            '--powerpill-jobs': 1,
+            '--powerpill-targets-file': 1,
+            '--powerpill-profile': 1,
+            '--powerpill-export': 1,
+            '--powerpill-export-base': 1,
+            '--powerpill-import': 1,
         })),
     }
     for rpo in RECOGNIZED_PACMAN_OPTIONS:
         pargs[rpo] = 0
     argq = collections.deque(expand_recognized_pacman_short_options(XCGF.expand_short_args(args)))
     included_stdin = False
+    read_targets = False
+    # Targets are collected in a dict to remove duplicates while they are read.
+    targets = dict()
     while argq:
         arg = argq.popleft()
 
         if arg == '-':
             if not included_stdin:
                 included_stdin = True
-                pargs['args'].extend(XCPF.get_args_from_stdin())
+                targets.update((target, None) for target in read_stdin_targets())
             else:
-                pargs['args'].append(arg)
+                targets[arg] = None
             continue
 
         if arg == '--':
             if not included_stdin:
                 argq = XCPF.maybe_insert_args_from_stdin(argq)
-            pargs['args'].extend(argq)
+            targets.update((target, None) for target in argq)
             break
 
         if arg[:2] == '--' and arg[2:] in RECOGNIZED_PACMAN_OPTIONS:
@@ -214,6 +384,51 @@ def parse_args(args=None):  # pylint: disable=too-many-statements,too-many-branc
         elif arg == '--powerpill-clean':
             pargs['powerpill_clean'] = True
 
+        elif arg == '--powerpill-targets-file':
+            try:
+                next_arg = argq.popleft()
+            except IndexError as err:
+                raise ArgumentError('no file path given for "{}"'.format(arg)) from err
+            if next_arg == '-':
+                included_stdin = True
+            read_targets = True
+            targets.update((target, None) for target in read_targets_file(next_arg))
+
+        elif arg == '--powerpill-serve':
+            pargs['powerpill_serve'] = True
+
+        elif arg == '--powerpill-plan':
+            pargs['powerpill_plan'] = True
+
+        elif arg == '--powerpill-profile':
+            try:
+                next_arg = argq.popleft()
+            except IndexError as err:
+                raise ArgumentError('no file path given for "{}"'.format(arg)) from err
+            pargs['powerpill_profile'] = os.path.abspath(next_arg)
+
+        elif arg in ('--powerpill-export', '--powerpill-export-base', '--powerpill-import'):
+            try:
+                next_arg = argq.popleft()
+            except IndexError as err:
+                raise ArgumentError('no file path given for "{}"'.format(arg)) from err
+            pargs[arg[2:].replace('-', '_')] = os.path.abspath(next_arg)
+
+        elif arg in ('--powerpill-root', '--powerpill-jobs'):
+            try:
+                next_arg = argq.popleft()
+            except IndexError as err:
+                raise ArgumentError('no argument for option {}'.format(arg)) from err
+            if arg == '--powerpill-root':
+                pargs['powerpill_roots'].append(os.path.abspath(next_arg))
+            else:
+                try:
+                    pargs['powerpill_jobs'] = int(next_arg)
+                except ValueError as err:
+                    raise ArgumentError('invalid number of jobs: {}'.format(next_arg)) from err
+                if pargs['powerpill_jobs'] < 1:
+                    raise ArgumentError('the number of jobs must be at least 1')
+
         elif arg[0] == '-':
             # (short argument if present, long argument, internal name)
             for conf_opt in PACMAN_CONF_OPTS:
@@ -248,13 +463,18 @@ def parse_args(args=None):  # pylint: disable=too-many-statements,too-many-branc
                     else:
                         pargs[name].append(next_arg)
         else:
-            pargs['args'].append(arg)
+            targets[arg] = None
+    # Non-sync operations are passed to Pacman from the raw arguments.
+    if read_targets and not pargs['sync']:
+        raise ArgumentError('--powerpill-targets-file is only supported for sync operations')
+    pargs['args'] = list(targets)
     return pargs
 
 
-def unparse_args(pargs):  # pylint: disable=too-many-branches
+def unparse_args(pargs, targets=True):  # pylint: disable=too-many-branches
     '''
-    Convert parsed arguments to a list of Pacman arguments.
+    Convert parsed arguments to a list of Pacman arguments. Targets of sync
+    operations are omitted if targets is False.
     '''
     # All of the argument parsing assumes a sync operation and so overlapping
     # short arguments are expanded to their long sync arguments, which breaks
@@ -293,8 +513,9 @@ def unparse_args(pargs):  # pylint: disable=too-many-branches
         yield whatever
     for whatever in pargs['options']:
         yield whatever
-    for whatever in pargs['args']:
-        yield whatever
+    if targets:
+        for whatever in pargs['args']:
+            yield whatever
 
 
 def display_help():
@@ -321,8 +542,64 @@ OPTIONS
         Default: {powerpill_config}
 
     --powerpill-clean
-        Clean up leftover .aria2 files from an unrecoverable download. Use this
-        option to resolve aria2c length mismatch errors.
+        Clean up leftover .aria2 files from an unrecoverable download along
+        with the partial packages. Use this option to resolve aria2c length
+        mismatch errors. If "clean/keep versions" is set in the configuration
+        file, old package versions and orphaned signatures are removed from the
+        cache as well. Partial downloads do not count as versions.
+
+    --powerpill-plan
+        Print the transfer plan as JSON instead of downloading anything. The
+        plan lists the backend (file, pacserve, peers, rsync or aria2) and size
+        of each file along with per-backend totals and estimated durations
+        based on the throughput observed in previous runs. Packages are
+        resolved against the current sync databases.
+
+    --powerpill-profile <path>
+        Profile the run and save a cProfile dump to <path>.pstats and a
+        timeline of the run's phases and subprocesses in the Chrome trace event
+        format to <path>.trace.json.
+
+    --powerpill-export <path>
+        Resolve the sync targets or system upgrade, download the packages and
+        write them to an offline bundle along with their signatures, the sync
+        databases and a manifest. Nothing is installed. Pass --dbpath with a
+        copy of the database directory of an offline host to resolve the
+        packages for that host. Large bundles are split into chunks if
+        "bundle/chunk size" is set in the configuration file.
+
+    --powerpill-export-base <path>
+        Omit files from the exported bundle that are identical in the given
+        previous bundle. The previous bundle must be imported first.
+
+    --powerpill-import <path>
+        Import an offline bundle into the cache and sync database directories.
+        All files are verified against the manifest before they are moved into
+        place. Bundles for other architectures are rejected.
+
+    --powerpill-serve
+        Serve verified packages from the local cache to other Powerpill
+        instances on the local network. See the "peers" section of the
+        powerpill.json man page.
+
+    --powerpill-targets-file <path>
+        Read additional targets from a file, one or more per line. Text after
+        "#" is ignored. Use "-" to read from stdin. Duplicate targets are
+        removed and large target lists are passed to Pacman via stdin. Only
+        supported for sync operations.
+
+    --powerpill-root <path>
+        Run the sync operation for the given installation root or Pacman
+        configuration file. This option may be passed multiple times to update
+        several roots at once. The sync databases are refreshed once, the
+        packages of all roots are downloaded in a single transfer and the
+        installations run in parallel if --noconfirm is passed to Pacman,
+        otherwise one at a time.
+
+    --powerpill-jobs <n>
+        The maximum number of parallel installations with --powerpill-root and
+        --noconfirm.
+        Default: powerpill/parallel installations in powerpill.json
 
 '''.format(
         name=name,
@@ -332,6 +609,179 @@ OPTIONS
     )
 
 
+def get_pacman_config_includes(path, globs=None):
+    '''
+    Return the paths of a Pacman configuration file and of all files that it
+    includes, recursively.
+
+    Include accepts glob patterns. If a dict is passed as globs, each pattern
+    is mapped to its sorted list of matches in it so that callers can detect
+    files that are added or removed later (see get_glob_matches).
+    '''
+    paths = list()
+    queue = [path]
+    while queue:
+        path = queue.pop(0)
+        if path in paths:
+            continue
+        paths.append(path)
+        try:
+            with open(path) as handle:
+                for line in handle:
+                    key, sep, val = line.partition('=')
+                    if sep and key.strip() == 'Include':
+                        pattern = val.strip()
+                        matches = sorted(glob.glob(pattern))
+                        if globs is not None:
+                            globs[pattern] = matches
+                        queue.extend(matches)
+        except (OSError, UnicodeDecodeError):
+            pass
+    return paths
+
+
+def get_glob_matches(patterns):
+    '''
+    Return a dict mapping the glob patterns to their sorted lists of matches.
+    '''
+    return dict((pattern, sorted(glob.glob(pattern))) for pattern in patterns)
+
+
+def get_package_signature_checks(path):
+    '''
+    Return a dict mapping the repositories in a Pacman configuration file to
+    False if their SigLevel disables package signature checks, otherwise True.
+    '''
+    siglevels = dict()
+
+    def read(path, section, seen):
+        # Included files are read in place, so sections carry over.
+        if path in seen:
+            return section
+        seen.add(path)
+        try:
+            with open(path) as handle:
+                lines = handle.readlines()
+        except (OSError, UnicodeDecodeError):
+            return section
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if line[:1] == '[' and line[-1:] == ']':
+                section = line[1:-1]
+                siglevels.setdefault(section, list())
+                continue
+            key, sep, val = line.partition('=')
+            if not sep:
+                continue
+            key = key.strip()
+            if key == 'Include':
+                for include in sorted(glob.glob(val.strip())):
+                    section = read(include, section, seen)
+            elif key == 'SigLevel' and section is not None:
+                siglevels.setdefault(section, list()).extend(val.split())
+        return section
+
+    read(path, None, set())
+    checks = dict()
+    for repo, tokens in siglevels.items():
+        if repo == 'options':
+            continue
+        # Repository levels refine the default level in the options section.
+        check = True
+        for token in siglevels.get('options', list()) + tokens:
+            if token in ('Never', 'PackageNever'):
+                check = False
+            elif token in ('Optional', 'Required', 'PackageOptional', 'PackageRequired'):
+                check = True
+        checks[repo] = check
+    return checks
+
+
+def get_file_states(paths):
+    '''
+    Return a list of (path, size, modification time) tuples. Missing files are
+    represented by None.
+    '''
+    states = list()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            states.append((path, None, None))
+        else:
+            states.append((path, stat.st_size, stat.st_mtime_ns))
+    return states
+
+
+def load_pacman_config(path, snapshot_path=None):
+    '''
+    Load a Pacman configuration file.
+
+    If a snapshot path is given, the parsed configuration, including the
+    expanded server lists of all included mirrorlists, is stored there and
+    reused until the configuration file or any of its includes change, or until
+    files are added to or removed from the matches of an Include pattern. The
+    snapshot is only loaded if it is owned by root or the current user and is
+    not writable by anyone else, because loading it may execute code.
+    '''
+    if snapshot_path is None:
+        return XCPF.PacmanConfig.PacmanConfig(path)
+
+    path = os.path.abspath(path)
+    try:
+        with open(snapshot_path, 'rb') as handle:
+            stat = os.fstat(handle.fileno())
+            if stat.st_uid not in (0, os.getuid()) or stat.st_mode & 0o022:
+                logging.warning('ignoring untrusted snapshot %s', snapshot_path)
+                raise PermissionError(snapshot_path)
+            snapshots = pickle.load(handle)
+        snapshot = snapshots[path]
+    except Exception:  # pylint: disable=broad-except
+        # Missing, untrusted, outdated or corrupt snapshots are simply recompiled.
+        snapshots = dict()
+        snapshot = None
+
+    if snapshot is not None and (
+        get_file_states(snapshot['paths']) == snapshot['states'] and
+        get_glob_matches(snapshot.get('globs', ())) == snapshot.get('globs')
+    ):
+        logging.debug('loaded %s from snapshot', path)
+        return snapshot['conf']
+
+    pacman_conf = XCPF.PacmanConfig.PacmanConfig(path)
+    globs = dict()
+    # The parser itself is included so that an update invalidates the snapshot.
+    paths = get_pacman_config_includes(path, globs) + [XCPF.PacmanConfig.__file__]
+    snapshots[path] = {
+        'paths': paths,
+        'states': get_file_states(paths),
+        'globs': globs,
+        'conf': pacman_conf,
+    }
+    tmp_path = snapshot_path + '.tmp'
+    try:
+        try:
+            os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        except FileExistsError:
+            pass
+        with open(tmp_path, 'wb') as handle:
+            os.fchmod(handle.fileno(), 0o644)
+            pickle.dump(snapshots, handle)
+        os.replace(tmp_path, snapshot_path)
+    except PermissionError as err:
+        # Unprivileged runs cannot update the snapshot of privileged runs.
+        logging.debug('not saving %s [%s]', snapshot_path, err)
+    except Exception as err:  # pylint: disable=broad-except
+        # Pickling fails with various exceptions for unpicklable attributes. The
+        # snapshot is only an optimization so this must never abort the run.
+        logging.warning('failed to save %s [%s]', snapshot_path, err)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+    return pacman_conf
+
+
 def get_pacman_conf(pargs, powerpill_conf):
     '''
     Get the pacman configuration file.
@@ -339,8 +789,16 @@ def get_pacman_conf(pargs, powerpill_conf):
     if not pargs['pacman_config']:
         pargs['pacman_config'] = powerpill_conf.get('pacman/config')
 
+    if powerpill_conf.get('powerpill/config snapshot'):
+        snapshot_path = os.path.join(
+            powerpill_conf.get('powerpill/cache dir'),
+            PACMAN_CONFIG_SNAPSHOT_FILE
+        )
+    else:
+        snapshot_path = None
+
     try:
-        pacman_conf = XCPF.PacmanConfig.PacmanConfig(pargs['pacman_config'])
+        pacman_conf = load_pacman_config(pargs['pacman_config'], snapshot_path)
     except FileNotFoundError as err:
         logging.error('failed to load %s [%s]', pargs['pacman_config'], err)
         return None
@@ -377,8 +835,26 @@ class ArgumentError(PowerpillError):
     '''Exceptions raised by the Config class.'''
 
 
+class DownloadInterrupted(PowerpillError):
+    '''Exceptions raised when a download is interrupted by a signal.'''
+
+
 # ------------------------------- Config Class ------------------------------- #
 
+def flatten_config(obj, prefix=''):
+    '''
+    Iterate over (path, value) pairs for all entries in a nested configuration
+    object, including intermediate objects. Null values are omitted.
+    '''
+    for key, val in obj.items():
+        if val is None:
+            continue
+        path = prefix + key
+        yield path, val
+        if isinstance(val, dict):
+            yield from flatten_config(val, path + '/')
+
+
 class Config():
     '''
     JSON object wrapper for implementing a configuration file.
@@ -386,24 +862,53 @@ class Config():
     DEFAULTS = {
         'aria2': {
             'path': '/usr/bin/aria2c',
+            'auto tune': False,
+        },
+        'bundle': {
+            'chunk size': None,
+        },
+        'clean': {
+            'keep versions': None,
+            'jobs': None,
         },
         'pacman': {
             'path': '/usr/bin/pacman',
             'config': '/etc/pacman.conf',
+            'gpg path': '/usr/bin/gpg',
+        },
+        'peers': {
+            'address': '',
+            'discover': False,
+            'port': 15679,
+            'servers': [],
+            'timeout': 1,
         },
         'powerpill': {
             'select': True,
             'reflect databases': False,
+            'cache dir': POWERPILL_CACHE_DIR,
+            'config snapshot': True,
+            'download order': 'default',
+            'parallel installations': 4,
+            'resolution cache': True,
+            'signal timeout': 30,
+            'staging dir': None,
+            'staging budget': None,
+            'verify signatures': False,
+            'verification jobs': os.cpu_count(),
         },
         'rsync': {
             'rsync': '/usr/bin/rsync',
+            'repos': {},
         },
     }
 
     def __init__(self, path=None):
+        self.defaults_lookup = dict(flatten_config(self.DEFAULTS))
         if path is None:
             self.obj = dict()
             self.path = None
+            self.lookup = dict()
         else:
             self.load(path)
 
@@ -424,6 +929,7 @@ Check the file for syntax errors.'''.format(path, err),
         except FileNotFoundError as err:
             raise ConfigError(str(err), error=err) from err
         self.path = path
+        self.lookup = dict(flatten_config(self.obj))
 
     def save(self, path=None):
         '''
@@ -440,24 +946,11 @@ Check the file for syntax errors.'''.format(path, err),
         '''
         Return the requested entry or None if it does not exist.
         '''
-        obj = self.obj
-        args = args.split('/')
-        for arg in args:
-            try:
-                obj = obj[arg]
-            except KeyError:
-                obj = None
-                break
-        # Get default if not found.
-        if obj is None:
-            obj = self.DEFAULTS
-            for arg in args:
-                try:
-                    obj = obj[arg]
-                except KeyError:
-                    obj = None
-                    break
-        return obj
+        try:
+            return self.lookup[args]
+        except KeyError:
+            # Get default if not found.
+            return self.defaults_lookup.get(args)
 
     def set(self, args, value):
         '''
@@ -472,151 +965,1658 @@ Check the file for syntax errors.'''.format(path, err),
                 obj[arg] = dict()
                 obj = obj[arg]
         obj[args[-1]] = value
+        self.lookup = dict(flatten_config(self.obj))
 
 
-# -------------------------------- Powerpill --------------------------------- #
+# ----------------------------- Persistent State ----------------------------- #
 
-class Powerpill():
+def load_state(path):
     '''
-    Main program class.
+    Load a JSON state file. Return None if it is missing or unreadable.
     '''
+    try:
+        return XCGF.load_json(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        logging.warning('ignoring state file %s [%s]', path, err)
+        return None
 
-    def __init__(self, pargs, pm2ml_pargs=None, ttl=pm2ml.DEFAULT_TTL):
 
-        self.pargs = pargs
-        self.conf = Config(pargs['powerpill_config'])
-        self.pacman_conf = get_pacman_conf(pargs, self.conf)
-        self.db_lock = None
-        if pm2ml_pargs is None:
-            pm2ml_pargs = pm2ml.parse_args([])
-        self.pm2ml = pm2ml.Pm2ml(pm2ml_pargs, pacman_conf=self.pacman_conf)
+def save_state(path, obj):
+    '''
+    Atomically save a JSON state file. Failures are logged but not fatal because
+    the state only serves to speed up subsequent runs.
+    '''
+    tmp_path = path + '.tmp'
+    try:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except FileExistsError:
+            pass
+        with open(tmp_path, 'w') as handle:
+            json.dump(obj, handle, indent='  ', sort_keys=True)
+        os.replace(tmp_path, path)
+    except PermissionError as err:
+        # Unprivileged runs cannot update the state of privileged runs.
+        logging.debug('not saving %s [%s]', path, err)
+    except OSError as err:
+        logging.warning('failed to save %s [%s]', path, err)
+
+
+# ----------------------------- Resolution Cache ----------------------------- #
+
+class ResolutionCache():
+    '''
+    Cache of download queues keyed on the database state and the normalized
+    pm2ml arguments.
 
-    # rsync has a hard limit of 1000 arguments (someone actually hit this and
-    # reported it), so this may return multiple commands to handle all arguments.
-    def download_queue_to_rsync_cmds(
-        self,
-        rsync_server,
-        queue,
-        output_dir=None,
-    ):  # pylint: disable=too-many-locals
+    Packages are stored by repository and name and are looked up again in the
+    sync databases when the entry is used, which is much faster than a full
+    resolution.
+    '''
+
+    def __init__(self, path, size=RESOLUTION_CACHE_SIZE):
+        self.path = path
+        self.size = size
+
+    @staticmethod
+    def get_key(pacman_conf, pacman_config_path, pm2ml_args):
         '''
-        Convert a download queue to an rsync command list.
+        Return a key that changes whenever the sync databases, the local
+        database, the Pacman configuration, including the mirrorlists that it
+        includes, or the arguments change.
         '''
-        cmd = [self.conf.get('rsync/path'), '-aL'] + self.conf.get('rsync/args')
+        dbpath = pacman_conf.options['DBPath']
+        state = list()
+        sync_dir = os.path.join(dbpath, 'sync')
+        try:
+            with os.scandir(sync_dir) as entries:
+                for entry in entries:
+                    stat = entry.stat()
+                    state.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        state.sort()
+        # Installing, upgrading and removing packages adds or removes entries in
+        # the local database directory, which updates its modification time.
+        paths = [os.path.join(dbpath, 'local')]
+        # The cached download queues contain the mirror URLs. The matches of
+        # Include patterns are included so that added files change the key.
+        globs = dict()
+        if pacman_config_path:
+            paths.extend(get_pacman_config_includes(pacman_config_path, globs))
+        state.extend(get_file_states(paths))
+        state.extend(sorted(globs.items()))
+        key = hashlib.sha256(
+            json.dumps((state, pacman_conf.options), sort_keys=True, default=str).encode()
+        )
+        # The arguments include the targets, which may be numerous, so they are
+        # hashed one at a time instead of being serialized together.
+        for arg in pm2ml_args:
+            key.update(b'\0' + arg.encode())
+        return key.hexdigest()
 
-        url = urllib.parse.urlparse(rsync_server)
-        host = url.netloc
-        # [1:] to remove initial slash
-        path = url.path[1:].replace('$arch', self.pacman_conf.options['Architecture'])
+    def get(self, key, handle):
+        '''
+        Return the cached download queue for the key or None if there is no
+        valid entry.
+        '''
+        state = load_state(self.path)
+        try:
+            entry = state['entries'][key]
+        except (KeyError, TypeError):
+            return None
+        syncdbs = dict((db.name, db) for db in handle.get_syncdbs())
+        download_queue = pm2ml.DownloadQueue()
+        for repo, name, urls, sigs in entry['sync_pkgs']:
+            try:
+                pkg = syncdbs[repo].get_pkg(name)
+            except KeyError:
+                pkg = None
+            if pkg is None:
+                logging.debug('discarding cached resolution: %s/%s not found', repo, name)
+                return None
+            download_queue.add_sync_pkg(pkg, urls, sigs)
+        return download_queue
+
+    def put(self, key, download_queue):
+        '''
+        Store the download queue under the given key.
+        '''
+        # AUR packages and databases are not resolved from the sync databases.
+        if download_queue.aur_pkgs or download_queue.dbs:
+            return
+        state = load_state(self.path)
+        try:
+            entries = state['entries']
+        except (KeyError, TypeError):
+            entries = dict()
+        entries[key] = {
+            'time': time.time(),
+            'sync_pkgs': [
+                (pkg.db.name, pkg.name, list(urls), sigs)
+                for pkg, urls, sigs in download_queue.sync_pkgs
+            ],
+        }
+        keys = sorted(entries, key=lambda k: entries[k]['time'], reverse=True)
+        for old_key in keys[self.size:]:
+            del entries[old_key]
+        save_state(self.path, {'entries': entries})
+
+
+# ------------------------------ Download Order ------------------------------- #
+
+def strip_version_constraint(dep):
+    '''
+    Remove the version constraint from a dependency string.
+    '''
+    return re.split(r'[<>=]', dep, maxsplit=1)[0]
 
-        host_added = False
 
-        if not output_dir:
-            output_dir = '.'
+def get_dependency_order(sync_pkgs):
+    '''
+    Return the download queue entries ordered such that dependencies precede
+    the packages that require them. The original order is otherwise preserved.
+    '''
+    providers = dict()
+    for entry in sync_pkgs:
+        pkg = entry[0]
+        providers.setdefault(pkg.name, entry)
+        for prov in pkg.provides:
+            providers.setdefault(strip_version_constraint(prov), entry)
+
+    ordered = list()
+    visited = set()
+
+    def visit(entry):
+        pkg = entry[0]
+        if pkg.filename in visited:
+            return
+        visited.add(pkg.filename)
+        for dep in pkg.depends:
+            try:
+                visit(providers[strip_version_constraint(dep)])
+            except KeyError:
+                continue
+        ordered.append(entry)
 
-        args = list()
+    for entry in sync_pkgs:
+        visit(entry)
+    return ordered
 
-        for db, sigs, files in queue.dbs:  # pylint: disable=invalid-name
-            if files:
-                db_ext = FILES_EXT
-            else:
-                db_ext = DB_EXT
-            db_path = '::' + os.path.join(path.replace('$repo', db.name), db.name + db_ext)
-            if not host_added:
-                args.append(host + db_path)
-                host_added = True
-            else:
-                args.append(db_path)
-            if sigs:
-                args.append(db_path + SIG_EXT)
 
-        for pkg, _urls, sigs in queue.sync_pkgs:
-            pkg_path = '::' + os.path.join(path.replace('$repo', pkg.db.name), pkg.filename)
-            if not host_added:
-                args.append(host + pkg_path)
-                host_added = True
-            else:
-                args.append(pkg_path)
-            if sigs:
-                args.append(pkg_path + SIG_EXT)
+def order_sync_pkgs(sync_pkgs, order):
+    '''
+    Return the sync package entries of a download queue in the given order. See
+    DOWNLOAD_ORDERS.
+    '''
+    if order == 'default':
+        return list(sync_pkgs)
+    if order == 'smallest first':
+        return sorted(sync_pkgs, key=lambda entry: entry[0].size)
+    if order == 'largest first':
+        return sorted(sync_pkgs, key=lambda entry: entry[0].size, reverse=True)
+    if order == 'dependencies':
+        return get_dependency_order(sync_pkgs)
+    raise ConfigError(
+        'invalid download order: {} (expected one of {})'.format(
+            order,
+            ', '.join('"{}"'.format(o) for o in DOWNLOAD_ORDERS)
+        )
+    )
 
-        # handle the hard limit
-        rsync_limit = 1000
-        arg_limit = rsync_limit - (len(cmd) + 1)
-        assert arg_limit > 0, 'rsync command construction failed due to argument limit'
-        while args:
-            yield cmd + args[:arg_limit] + [output_dir]
-            args = args[arg_limit:]
 
-    def get_pm2ml_pkg_download_args(self, dpath=None, ignore=True):
+# ---------------------------- Transfer Statistics ---------------------------- #
+
+def get_url_host(url):
+    '''
+    Return the host of a URL.
+    '''
+    return urllib.parse.urlparse(url).netloc or None
+
+
+def get_primary_hosts(queue):
+    '''
+    Return the set of hosts of the preferred URLs of the entries in a download
+    queue.
+    '''
+    hosts = set()
+    for db, _sigs, _files in queue.dbs:  # pylint: disable=invalid-name
+        if db.servers:
+            hosts.add(get_url_host(db.servers[0]))
+    for _pkg, urls, _sigs in queue.sync_pkgs:
+        if urls:
+            hosts.add(get_url_host(urls[0]))
+    hosts.discard(None)
+    return hosts
+
+
+def get_file_sizes(output_dir, filenames):
+    '''
+    Return a dict mapping filenames to the sizes of the files in the output
+    directory. Missing files have a size of 0.
+    '''
+    sizes = dict()
+    for filename in filenames:
+        try:
+            sizes[filename] = os.path.getsize(os.path.join(output_dir or '.', filename))
+        except OSError:
+            sizes[filename] = 0
+    return sizes
+
+
+class ThroughputHistory():
+    '''
+    Moving averages of the throughput observed per host in previous transfers.
+
+    Aria2 downloads from several hosts at once, so the throughput of an Aria2
+    transfer is attributed to each host that was preferred for a file in it.
+    '''
+
+    def __init__(self, path, weight=THROUGHPUT_WEIGHT):
+        self.path = path
+        self.weight = weight
+        self.hosts = dict()
+        state = load_state(path)
+        if isinstance(state, dict):
+            self.hosts = state.get('hosts', dict())
+
+    def get(self, host):
         '''
-        Iterate over pm2ml options for downloading packages.
+        Return the throughput in bytes per second for the host or None if it is
+        unknown.
         '''
-        if dpath:
-            yield '-o'
-            yield dpath
-        for opt in ('sysupgrade', 'verbose', 'debug'):
-            for _ in range(self.pargs[opt]):
-                yield '--' + opt
-        for opt in self.pargs['pm2ml_options']:
-            yield opt
-        if ignore:
-            for pkg in self.pacman_conf.options['IgnorePkg']:
-                yield '--ignore'
-                yield pkg
-            for grp in self.pacman_conf.options['IgnoreGroup']:
-                yield '--ignoregroup'
-                yield grp
-        if self.conf.get('powerpill/select'):
-            yield '--select'
-        for arg in self.pargs['args']:
-            yield arg
+        try:
+            return self.hosts[host]['bytes per second']
+        except (KeyError, TypeError):
+            return None
 
-    def download(self, pm2ml_args, dbs=False, force=False):
+    def record(self, hosts, nbytes, seconds):
         '''
-        Download files specified by pm2ml arguments.
+        Record a transfer of the given number of bytes in the given number of
+        seconds from the given hosts.
         '''
-#     for pkg in self.pacman_conf.options['IgnorePkg']:
-#       pm2ml_args.extend(('--ignore', pkg))
-#     for grp in self.pacman_conf.options['IgnoreGroup']:
-#       pm2ml_args.extend(('--ignoregroup', grp))
-#     if self.conf.get('powerpill/select'):
-#       pm2ml_args.append('--select')
-        if dbs:
-            #       pm2ml_args.append('--preference')
-            reflect = self.conf.get('powerpill/reflect databases')
-        else:
-            reflect = True
-        # This must be added last.
-        if reflect and self.conf.get('reflector/args'):
-            pm2ml_args += ['--reflector'] + self.conf.get('reflector/args')
-        pm2ml_pargs = pm2ml.parse_args(pm2ml_args)
-        sync_pkgs, sync_deps, \
-            _aur_pkgs, _aur_deps, \
-            _not_found, _unknown_deps, _orphans = \
-            self.pm2ml.resolve_targets_from_arguments(pm2ml_pargs)
+        if nbytes < THROUGHPUT_MIN_BYTES or seconds <= 0:
+            return
+        sample = nbytes / seconds
+        for host in hosts:
+            previous = self.get(host)
+            if previous is None:
+                throughput = sample
+            else:
+                throughput = previous + self.weight * (sample - previous)
+            self.hosts[host] = {
+                'bytes per second': throughput,
+                'time': time.time(),
+            }
 
-        download_queue = \
-            self.pm2ml.build_download_queue(
-                pm2ml_pargs,
-                sync_pkgs | sync_deps
-            )
+    def save(self):
+        '''
+        Save the history.
+        '''
+        save_state(self.path, {'hosts': self.hosts})
 
-        rsync_queue = pm2ml.DownloadQueue()
+
+def summarize_routes(routes, history):
+    '''
+    Summarize the routes of a transfer plan per backend with estimated
+    durations. Local file copies are not included in the estimates. Bytes from
+    hosts without recorded throughput are counted as unestimated.
+    '''
+    backends = dict()
+    for route in routes:
+        summary = backends.setdefault(route['backend'], {
+            'files': 0,
+            'bytes': 0,
+            'estimated seconds': 0.0,
+            'unestimated bytes': 0,
+        })
+        summary['files'] += 1
+        summary['bytes'] += route['bytes']
+        if route['backend'] == 'file':
+            continue
+        throughput = history.get(route['host'])
+        if throughput:
+            summary['estimated seconds'] += route['bytes'] / throughput
+        else:
+            summary['unestimated bytes'] += route['bytes']
+    return {
+        'backends': backends,
+        'bytes': sum(b['bytes'] for b in backends.values()),
+        'estimated seconds': sum(b['estimated seconds'] for b in backends.values()),
+        'unestimated bytes': sum(b['unestimated bytes'] for b in backends.values()),
+        'files': routes,
+    }
+
+
+# ------------------------------- Aria2 Tuning -------------------------------- #
+
+def get_network_id():
+    '''
+    Return an identifier for the current network based on the interface and
+    the address of the default gateway.
+    '''
+    try:
+        with open('/proc/net/route') as handle:
+            for line in handle:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == '00000000':
+                    gateway = socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+                    return '{} {}'.format(fields[0], gateway)
+    except (OSError, ValueError, struct.error):
+        pass
+    return 'unknown'
+
+
+def measure_rtt(url, timeout=RTT_TIMEOUT):
+    '''
+    Return the time in seconds to establish a TCP connection to the host of the
+    URL or None if the connection fails. The host is resolved first so that
+    the name lookup is not included. The lookup is subject to the same timeout
+    but getaddrinfo cannot be interrupted, so it is run in a daemon thread that
+    is abandoned if it does not finish in time.
+    '''
+    url = urllib.parse.urlparse(url)
+    try:
+        if not url.hostname:
+            return None
+        port = url.port or {'https': 443, 'ftp': 21}.get(url.scheme, 80)
+    except ValueError:
+        return None
+
+    addresses = list()
+
+    def resolve():
+        try:
+            addresses.extend(socket.getaddrinfo(url.hostname, port, type=socket.SOCK_STREAM))
+        except OSError:
+            pass
+
+    resolver = threading.Thread(target=resolve, daemon=True)
+    resolver.start()
+    resolver.join(timeout)
+    if not addresses:
+        return None
+    family, socktype, proto, _name, address = addresses[0]
+    try:
+        with socket.socket(family, socktype, proto) as sock:
+            sock.settimeout(timeout)
+            start = time.monotonic()
+            sock.connect(address)
+            return time.monotonic() - start
+    except OSError:
+        return None
+
+
+def clamp(value, lower, upper):
+    '''
+    Clamp a value to the given bounds.
+    '''
+    return max(lower, min(value, upper))
+
+
+def get_aria2_tuning(sizes, throughput, rtt):
+    '''
+    Return a dict of Aria2 options for downloading files of the given sizes
+    over a link with the given throughput in bytes per second and round-trip
+    time in seconds.
+
+    Segments should be large compared to the bandwidth-delay product so that
+    the time to open a connection is negligible. The split count lets the
+    largest file use all of its segments, while min-split-size keeps smaller
+    files from being split needlessly. Enough files are downloaded
+    concurrently to keep the link busy while small files spend most of their
+    time in connection setup.
+    '''
+    mib = 0x100000
+    sizes = sorted(sizes)
+    median = max(sizes[len(sizes) // 2], 1)
+    bdp = throughput * rtt
+    min_split_size = clamp(int(16 * bdp // mib), 1, 64)
+    split = clamp(-(-sizes[-1] // (min_split_size * mib)), 1, 16)
+    concurrency = clamp(-(-int(4 * bdp) // median), 5, 100)
+    return {
+        'max-concurrent-downloads': min(concurrency, max(len(sizes), 1)),
+        'min-split-size': '{:d}M'.format(min_split_size),
+        'split': split,
+    }
+
+
+# ----------------------------------- Peers ----------------------------------- #
+
+def discover_peers(port, timeout):
+    '''
+    Broadcast a discovery request on the local network and return the URLs of
+    the peers that respond within the timeout.
+    '''
+    urls = list()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.sendto(PEER_DISCOVERY_MESSAGE, ('<broadcast>', port))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (host, _port) = sock.recvfrom(1024)
+            except socket.timeout:
+                break
+            try:
+                peer_port = int(json.loads(data.decode())['port'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            url = 'http://{}:{:d}'.format(host, peer_port)
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def query_peer(url, filenames, timeout):
+    '''
+    Return the subset of the given filenames that a peer can serve.
+    '''
+    request = urllib.request.Request(
+        url.rstrip('/') + '/query',
+        data=json.dumps(list(filenames)).encode(),
+        headers={'Content-Type': 'application/json'}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return set(json.loads(response.read().decode()))
+
+
+class PeerRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Request handler for the peer server. Files are served with support for
+    single byte ranges so that Aria2 can download segments from peers.
+    '''
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug('%s: %s', self.address_string(), format % args)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        '''
+        Handle queries for available files.
+        '''
+        if self.path != '/query':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_error(400)
+            return
+        if length < 0:
+            self.send_error(400)
+            return
+        if length > PEER_QUERY_MAX_BYTES:
+            self.send_error(413)
+            return
+        try:
+            filenames = json.loads(self.rfile.read(length).decode())
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(filenames, list) \
+                or not all(isinstance(filename, str) for filename in filenames):
+            self.send_error(400, 'expected a list of filenames')
+            return
+        available = [
+            filename for filename in filenames
+            if self.server.peer.get_path(filename) is not None
+        ]
+        body = json.dumps(available).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        '''
+        Handle HEAD requests.
+        '''
+        self.send_file(send_body=False)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''
+        Handle GET requests.
+        '''
+        self.send_file(send_body=True)
+
+    def send_file(self, send_body=True):
+        '''
+        Send the requested file or the requested byte range of it.
+        '''
+        filename = urllib.parse.unquote(self.path.lstrip('/'))
+        path = self.server.peer.get_path(filename)
+        if path is None:
+            self.send_error(404)
+            return
+        stat = os.stat(path)
+        size = stat.st_size
+        start = 0
+        end = size - 1
+        status = 200
+        byte_range = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', '').strip())
+        if byte_range and (byte_range.group(1) or byte_range.group(2)):
+            if byte_range.group(1):
+                start = int(byte_range.group(1))
+                if byte_range.group(2):
+                    end = min(int(byte_range.group(2)), size - 1)
+            else:
+                start = max(size - int(byte_range.group(2)), 0)
+            if start > end:
+                self.send_error(416)
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(start, end, size))
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, 'rb') as handle:
+            handle.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = handle.read(min(remaining, 0x100000))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class PeerServer():
+    '''
+    Serve packages from the Pacman cache to other Powerpill instances on the
+    local network.
+
+    Only packages that are listed in the sync databases and that match the
+    checksums in the databases are served, along with their signature files.
+    The cache is verified in the background so that queries are answered
+    immediately from the set of verified packages. Verification results are
+    kept until the file or the sync databases change.
+    '''
+
+    def __init__(self, powerpill, port, address=''):
+        self.powerpill = powerpill
+        self.port = port
+        self.address = address
+        self.lock = threading.Lock()
+        self.sync_state = None
+        self.checksums = dict()
+        # Verified packages: filename -> (path, file state)
+        self.available = dict()
+
+    def update_checksums(self):
+        '''
+        Reload the package checksums if the sync databases have changed. Return
+        True if they were reloaded.
+        '''
+        sync_dir = os.path.join(self.powerpill.pacman_conf.options['DBPath'], 'sync')
+        try:
+            sync_paths = sorted(
+                os.path.join(sync_dir, name) for name in os.listdir(sync_dir)
+            )
+        except FileNotFoundError:
+            sync_paths = list()
+        sync_state = get_file_states(sync_paths)
+        if sync_state == self.sync_state:
+            return False
+        logging.info('loading package checksums from sync databases')
+        self.powerpill.initialize_alpm()
+        checksums = dict()
+        for db in self.powerpill.pm2ml.handle.get_syncdbs():
+            for pkg in db.pkgcache:
+                checksums[pkg.filename] = pkg.sha256sum
+        self.checksums = checksums
+        self.sync_state = sync_state
+        return True
+
+    def verify_cache(self):
+        '''
+        Verify the packages in the cache directories against the sync databases
+        and replace the set of available packages. Unchanged packages are not
+        hashed again unless the sync databases have changed.
+        '''
+        if self.update_checksums():
+            previous = dict()
+        else:
+            with self.lock:
+                previous = self.available
+        available = dict()
+        for cachedir in self.powerpill.pacman_conf.options['CacheDir']:
+            try:
+                filenames = sorted(os.listdir(cachedir))
+            except FileNotFoundError:
+                continue
+            for filename in filenames:
+                sha256sum = self.checksums.get(filename)
+                if sha256sum is None or filename in available:
+                    continue
+                path = os.path.join(cachedir, filename)
+                if os.path.exists(path + ARIA2_EXT):
+                    continue
+                state = get_file_states((path,))[0]
+                if state[1] is None:
+                    continue
+                if previous.get(filename) == (path, state) \
+                        or XCGF.get_checksum(path, typ='sha256') == sha256sum:
+                    available[filename] = (path, state)
+        with self.lock:
+            self.available = available
+
+    def verify_forever(self):
+        '''
+        Verify the cache periodically.
+        '''
+        while True:
+            try:
+                self.verify_cache()
+            except OSError as err:
+                logging.error('failed to verify the cache [%s]', err)
+            time.sleep(PEER_VERIFICATION_INTERVAL)
+
+    def get_path(self, filename):
+        '''
+        Return the path to a verified file in the cache or None if the file is
+        not available.
+        '''
+        if not filename or '/' in filename or filename.startswith('.'):
+            return None
+        if filename.endswith(SIG_EXT):
+            pkg_path = self.get_path(filename[:-len(SIG_EXT)])
+            if pkg_path is None or not os.path.isfile(pkg_path + SIG_EXT):
+                return None
+            return pkg_path + SIG_EXT
+        with self.lock:
+            try:
+                path, state = self.available[filename]
+            except KeyError:
+                return None
+        # Files that changed since they were verified are skipped until the next
+        # verification.
+        if get_file_states((path,))[0] != state:
+            return None
+        return path
+
+    def respond_to_discovery(self):
+        '''
+        Answer discovery broadcasts from other peers.
+        '''
+        reply = json.dumps({'port': self.port}).encode()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', self.port))
+            while True:
+                data, address = sock.recvfrom(1024)
+                if data == PEER_DISCOVERY_MESSAGE:
+                    sock.sendto(reply, address)
+
+    def serve_forever(self):
+        '''
+        Serve files until interrupted. Files are served on the configured
+        address while discovery requests are answered on all interfaces because
+        broadcasts are not received by sockets bound to a unicast address.
+        '''
+        httpd = http.server.ThreadingHTTPServer((self.address, self.port), PeerRequestHandler)
+        httpd.peer = self
+        discovery = threading.Thread(target=self.respond_to_discovery, daemon=True)
+        discovery.start()
+        verification = threading.Thread(target=self.verify_forever, daemon=True)
+        verification.start()
+        logging.info('serving peers on %s port %d', self.address or 'all interfaces', self.port)
+        with httpd:
+            httpd.serve_forever()
+
+
+# --------------------------- Signature Verification --------------------------- #
+
+def is_complete(path):
+    '''
+    Return True if the file exists and is not being downloaded by Aria2.
+    '''
+    return os.path.exists(path) and not os.path.exists(path + ARIA2_EXT)
+
+
+class SignatureVerifier():
+    '''
+    Verify package signatures on a thread pool while other packages are still
+    being downloaded.
+
+    A package is verified as soon as both the package and its signature are
+    complete. Packages with bad signatures are removed along with their
+    signatures. Signatures that cannot be checked, e.g. because the key is not
+    yet in the keyring or is not trusted, are left to Pacman. Successful
+    verifications are recorded and skipped on later runs while the files are
+    unchanged, e.g. when resuming an interrupted download.
+    '''
+
+    def __init__(self, cmd, output_dir, filenames, state_path, jobs=None):
+        self.cmd = cmd
+        self.output_dir = output_dir or '.'
+        self.pending = list(filenames)
+        self.state_path = state_path
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.futures = dict()
+        state = load_state(state_path)
+        try:
+            self.verified = state['verified']
+        except (KeyError, TypeError):
+            self.verified = dict()
+
+    def get_state(self, filename):
+        '''
+        Return the JSON-compatible state of a package and its signature.
+        '''
+        path = os.path.join(self.output_dir, filename)
+        return [list(state) for state in get_file_states((path, path + SIG_EXT))]
+
+    def poll(self):
+        '''
+        Submit complete packages for verification.
+        '''
+        pending = list()
+        for filename in self.pending:
+            path = os.path.join(self.output_dir, filename)
+            if is_complete(path) and is_complete(path + SIG_EXT):
+                self.futures[filename] = self.executor.submit(self.verify, filename)
+            else:
+                pending.append(filename)
+        self.pending = pending
+
+    def verify(self, filename):
+        '''
+        Verify the signature of a package with GnuPG and remove the package if
+        the signature is bad. Return SIGNATURE_VALID, SIGNATURE_BAD or
+        SIGNATURE_UNKNOWN.
+        '''
+        if self.verified.get(filename) == self.get_state(filename):
+            return SIGNATURE_VALID
+        path = os.path.join(self.output_dir, filename)
+        proc = subprocess.run(
+            self.cmd + [path + SIG_EXT, path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False
+        )
+        status = set(
+            line.split()[1] for line in proc.stdout.decode(errors='replace').splitlines()
+            if line.startswith('[GNUPG:] ') and len(line.split()) > 1
+        )
+        if 'BADSIG' in status:
+            logging.error('bad signature: %s', filename)
+            for invalid_path in (path, path + SIG_EXT):
+                try:
+                    os.unlink(invalid_path)
+                except FileNotFoundError:
+                    pass
+            return SIGNATURE_BAD
+        if proc.returncode == 0 and 'GOODSIG' in status \
+                and status & {'TRUST_FULLY', 'TRUST_ULTIMATE'}:
+            logging.debug('valid signature: %s', filename)
+            return SIGNATURE_VALID
+        logging.warning('unable to check signature, leaving it to pacman: %s', filename)
+        return SIGNATURE_UNKNOWN
+
+    def finish(self):
+        '''
+        Verify all remaining complete packages, record the results and return
+        the names of the packages with bad signatures.
+        '''
+        self.poll()
+        invalid = list()
+        for filename, future in self.futures.items():
+            result = future.result()
+            if result == SIGNATURE_VALID:
+                self.verified[filename] = self.get_state(filename)
+            elif result == SIGNATURE_BAD:
+                invalid.append(filename)
+        self.executor.shutdown()
+        for filename in list(self.verified):
+            if not os.path.exists(os.path.join(self.output_dir, filename)):
+                del self.verified[filename]
+        save_state(self.state_path, {'verified': self.verified})
+        return invalid
+
+
+# ------------------------------ Offline Bundles ------------------------------ #
+
+class ChunkedWriter():
+    '''
+    Write a stream to a single file or to numbered files of at most chunk_size
+    bytes each.
+    '''
+
+    def __init__(self, path, chunk_size=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.paths = list()
+        self.handle = None
+        self.remaining = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def next_chunk(self):
+        '''
+        Close the current file and open the next one.
+        '''
+        self.close()
+        if self.chunk_size:
+            path = BUNDLE_CHUNK_FORMAT.format(self.path, len(self.paths))
+            self.remaining = self.chunk_size
+        else:
+            path = self.path
+            self.remaining = float('inf')
+        self.paths.append(path)
+        self.handle = open(path, 'wb')
+
+    def write(self, data):
+        data = memoryview(data)
+        nbytes = len(data)
+        while data:
+            if self.handle is None or self.remaining <= 0:
+                self.next_chunk()
+            n = int(min(len(data), self.remaining))
+            self.handle.write(data[:n])
+            self.remaining -= n
+            data = data[n:]
+        return nbytes
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class ChunkedReader():
+    '''
+    Read a stream written by ChunkedWriter.
+    '''
+
+    def __init__(self, path):
+        if os.path.isfile(path):
+            self.paths = collections.deque((path,))
+        else:
+            self.paths = collections.deque()
+            while os.path.isfile(BUNDLE_CHUNK_FORMAT.format(path, len(self.paths))):
+                self.paths.append(BUNDLE_CHUNK_FORMAT.format(path, len(self.paths)))
+            if not self.paths:
+                raise PowerpillError('no bundle found at {}'.format(path))
+        self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        chunks = list()
+        while size != 0:
+            if self.handle is None:
+                if not self.paths:
+                    break
+                self.handle = open(self.paths.popleft(), 'rb')
+            data = self.handle.read(size)
+            if not data:
+                self.handle.close()
+                self.handle = None
+                continue
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+def get_bundle_member_path(name):
+    '''
+    Split a bundle member name into its section and file name.
+    '''
+    try:
+        section, filename = name.split('/', 1)
+    except ValueError as err:
+        raise PowerpillError('invalid bundle member: {}'.format(name)) from err
+    if section not in BUNDLE_SECTIONS or filename in ('', '.', '..') or '/' in filename:
+        raise PowerpillError('invalid bundle member: {}'.format(name))
+    return section, filename
+
+
+def read_bundle_manifest(path):
+    '''
+    Return the manifest of a bundle.
+    '''
+    with ChunkedReader(path) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+        member = tar.next()
+        if member is None or member.name != BUNDLE_MANIFEST:
+            raise PowerpillError('{} is not a Powerpill bundle'.format(path))
+        manifest = json.load(tar.extractfile(member))
+    if manifest.get('version') != BUNDLE_VERSION:
+        raise PowerpillError('unsupported bundle version: {}'.format(manifest.get('version')))
+    return manifest
+
+
+def write_bundle(path, files, base=None, chunk_size=None, **metadata):
+    '''
+    Write a bundle and return its manifest.
+
+    files is a list of (section, directory, filename, sha256) tuples. The
+    checksum is calculated if it is None. Files that are also listed in the
+    manifest of the base bundle with the same checksum are omitted from the
+    archive and only recorded in the manifest.
+    '''
+    if base is None:
+        base_files = dict()
+    else:
+        base_files = dict(
+            (entry['name'], entry['sha256'])
+            for entry in base['files'] + base['base files']
+        )
+    included = list()
+    excluded = list()
+    for section, dpath, filename, sha256 in files:
+        fpath = os.path.join(dpath, filename)
+        if sha256 is None:
+            sha256 = XCGF.get_checksum(fpath, typ='sha256')
+        entry = {
+            'name': section + '/' + filename,
+            'sha256': sha256,
+            'size': os.path.getsize(fpath),
+        }
+        if base_files.get(entry['name']) == sha256:
+            excluded.append(entry)
+        else:
+            included.append((fpath, entry))
+
+    manifest = dict(metadata)
+    manifest.update({
+        'version': BUNDLE_VERSION,
+        'created': int(time.time()),
+        'base': None if base is None else base['id'],
+        'files': [entry for _fpath, entry in included],
+        'base files': excluded,
+    })
+    manifest['id'] = hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode()
+    ).hexdigest()
+    data = json.dumps(manifest, indent='  ', sort_keys=True).encode()
+
+    with ChunkedWriter(path, chunk_size=chunk_size) as writer, \
+            tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        info = tarfile.TarInfo(BUNDLE_MANIFEST)
+        info.size = len(data)
+        info.mtime = manifest['created']
+        tar.addfile(info, io.BytesIO(data))
+        for fpath, entry in included:
+            tar.add(fpath, arcname=entry['name'], recursive=False)
+    manifest['chunks'] = writer.paths
+    return manifest
+
+
+def extract_bundle(path, dpaths, architecture=None):
+    '''
+    Extract a bundle in a single sequential pass. dpaths maps the sections of
+    the bundle to the directories in which to extract them. If an architecture
+    is given, bundles for other architectures are rejected before anything is
+    extracted.
+
+    Each file is written to a temporary file and only renamed to its final
+    name if its size and checksum match the manifest. Files that were omitted
+    from the bundle must already be present with the same checksum. Return the
+    manifest.
+    '''
+    with ChunkedReader(path) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+        member = tar.next()
+        if member is None or member.name != BUNDLE_MANIFEST:
+            raise PowerpillError('{} is not a Powerpill bundle'.format(path))
+        manifest = json.load(tar.extractfile(member))
+        if manifest.get('version') != BUNDLE_VERSION:
+            raise PowerpillError('unsupported bundle version: {}'.format(manifest.get('version')))
+        if architecture is not None and manifest.get('architecture') != architecture:
+            raise PowerpillError(
+                'bundle architecture {} does not match {}'.format(
+                    manifest.get('architecture'),
+                    architecture
+                )
+            )
+
+        for entry in manifest['base files']:
+            section, filename = get_bundle_member_path(entry['name'])
+            fpath = os.path.join(dpaths[section], filename)
+            try:
+                size = os.path.getsize(fpath)
+            except FileNotFoundError:
+                size = None
+            if size != entry['size'] \
+                    or XCGF.get_checksum(fpath, typ='sha256') != entry['sha256']:
+                raise PowerpillError(
+                    '{} is missing or modified, import the base bundle {} first'.format(
+                        fpath,
+                        manifest['base']
+                    )
+                )
+
+        expected = dict((entry['name'], entry) for entry in manifest['files'])
+        for member in iter(tar.next, None):
+            entry = expected.pop(member.name, None)
+            if entry is None or not member.isfile():
+                raise PowerpillError('unexpected bundle member: {}'.format(member.name))
+            section, filename = get_bundle_member_path(member.name)
+            fpath = os.path.join(dpaths[section], filename)
+            tmp_path = os.path.join(dpaths[section], '.{}.{:d}.tmp'.format(filename, os.getpid()))
+            checksum = hashlib.sha256()
+            size = 0
+            try:
+                with tar.extractfile(member) as src, open(tmp_path, 'wb') as dst:
+                    for block in iter(functools.partial(src.read, BUNDLE_BLOCK_SIZE), b''):
+                        checksum.update(block)
+                        dst.write(block)
+                        size += len(block)
+                if size != entry['size'] or checksum.hexdigest() != entry['sha256']:
+                    raise PowerpillError('checksum mismatch: {}'.format(member.name))
+                os.utime(tmp_path, (member.mtime, member.mtime))
+                os.replace(tmp_path, fpath)
+            finally:
+                try:
+                    os.unlink(tmp_path)
+                except FileNotFoundError:
+                    pass
+            logging.debug('imported %s', fpath)
+
+    if expected:
+        raise PowerpillError(
+            'incomplete bundle, missing {}'.format(', '.join(sorted(expected)))
+        )
+    return manifest
+
+
+# --------------------------------- Profiling --------------------------------- #
+
+class Profiler():
+    '''
+    Record the phases of a run and the subprocesses that it starts.
+
+    When enabled, the whole run is profiled with cProfile and the phases are
+    saved as a Chrome trace event timeline, which can be loaded in
+    chrome://tracing or Perfetto. When disabled, phases cost a single
+    function call.
+    '''
+    NULL_CONTEXT = contextlib.nullcontext()
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = path is not None
+        self.events = list()
+        self.profile = None
+        self.origin = time.perf_counter()
+
+    def __enter__(self):
+        if self.enabled:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        if self.enabled:
+            self.profile.disable()
+            self.save()
+
+    def record(self, name, start, end, tid=None, args=None):
+        '''
+        Record an event with start and end times from time.perf_counter().
+        '''
+        self.events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident() if tid is None else tid,
+            'args': args or dict(),
+        })
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def phase(self, name):
+        '''
+        Return a context manager that records the enclosed code as a phase.
+        '''
+        if not self.enabled:
+            return self.NULL_CONTEXT
+        return self._phase(name)
+
+    def save(self):
+        '''
+        Save the cProfile statistics and the trace.
+        '''
+        self.profile.dump_stats(self.path + '.pstats')
+        with open(self.path + '.trace.json', 'w') as handle:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, handle)
+        logging.info('saved profile to %s.pstats and %s.trace.json', self.path, self.path)
+
+
+def profiled(name):
+    '''
+    Decorator for Powerpill methods that records each call as a phase.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------------------------- Process Supervisor ---------------------------- #
+
+def get_download_queue_filenames(*queues):
+    '''
+    Iterate over the names of the files in the given download queues.
+    '''
+    for queue in queues:
+        for db, sigs, files in queue.dbs:  # pylint: disable=invalid-name
+            name = db.name + (FILES_EXT if files else DB_EXT)
+            yield name
+            if sigs:
+                yield name + SIG_EXT
+        for pkg, _urls, sigs in queue.sync_pkgs:
+            yield pkg.filename
+            if sigs:
+                yield pkg.filename + SIG_EXT
+
+
+class ProcessSupervisor():
+    '''
+    Context manager for running transfer subprocesses.
+
+    The processes are started in their own sessions so that a SIGINT from the
+    terminal only reaches them once, via this supervisor. Because they no
+    longer receive the terminal's signals, SIGINT, SIGTERM, SIGHUP and SIGQUIT
+    are all caught and forwarded to the running processes, which lets Aria2
+    and Rsync save their control files and exit cleanly. SIGHUP and SIGQUIT
+    are forwarded as SIGTERM. Processes that are still running after the
+    timeout are killed. A timeout of None or 0 waits indefinitely. A second
+    signal kills them immediately.
+    '''
+    SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT)
+    # Signals that are forwarded as a different signal.
+    FORWARDED_SIGNALS = {
+        signal.SIGHUP: signal.SIGTERM,
+        signal.SIGQUIT: signal.SIGTERM,
+    }
+
+    def __init__(self, timeout=None, profiler=None):
+        self.timeout = timeout or None
+        self.profiler = profiler or Profiler()
+        self.start_times = dict()
+        # Functions to call periodically while waiting for processes.
+        self.poll_callbacks = list()
+        self.processes = list()
+        self.received = None
+        self.deadline = None
+        self.previous_handlers = dict()
+
+    def __enter__(self):
+        # Signal handlers can only be set in the main thread.
+        if threading.current_thread() is threading.main_thread():
+            for signum in self.SIGNALS:
+                self.previous_handlers[signum] = signal.signal(signum, self.handle_signal)
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        try:
+            for proc in self.processes:
+                if proc.poll() is None:
+                    proc.terminate()
+                    self.set_deadline()
+            for proc in self.processes:
+                self.wait(proc)
+        finally:
+            for signum, handler in self.previous_handlers.items():
+                signal.signal(signum, handler)
+            self.previous_handlers.clear()
+
+    def handle_signal(self, signum, _frame):
+        '''
+        Forward the signal to all running processes.
+        '''
+        if self.received is not None:
+            logging.warning('received second signal, killing subprocesses')
+            self.kill()
+            return
+        self.received = signum
+        self.set_deadline()
+        logging.warning(
+            'received %s, waiting for subprocesses to exit',
+            signal.Signals(signum).name
+        )
+        forwarded = self.FORWARDED_SIGNALS.get(signum, signum)
+        for proc in self.processes:
+            if proc.poll() is None:
+                proc.send_signal(forwarded)
+
+    def set_deadline(self):
+        '''
+        Set the time after which processes that are still running are killed.
+        '''
+        if self.deadline is None and self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+
+    def kill(self):
+        '''
+        Kill all running processes.
+        '''
+        for proc in self.processes:
+            if proc.poll() is None:
+                proc.kill()
+
+    def popen(self, cmd, **kwargs):
+        '''
+        Start a supervised process. Arguments are passed through to
+        subprocess.Popen.
+        '''
+        if self.received is not None:
+            raise DownloadInterrupted('not starting {} after signal'.format(cmd[0]))
+        proc = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        self.processes.append(proc)
+        self.start_times[proc.pid] = time.perf_counter()
+        return proc
+
+    def wait(self, proc):
+        '''
+        Wait for a process to exit and return its exit code. If a signal has
+        been received, the process is killed when the timeout expires.
+        '''
+        while True:
+            try:
+                returncode = proc.wait(timeout=SUPERVISOR_POLL_INTERVAL)
+            except subprocess.TimeoutExpired:
+                if self.deadline is not None and time.monotonic() > self.deadline:
+                    logging.error('%s did not exit in time, killing it', proc.args[0])
+                    proc.kill()
+                for callback in self.poll_callbacks:
+                    callback()
+            else:
+                if self.profiler.enabled and proc.pid in self.start_times:
+                    self.profiler.record(
+                        os.path.basename(proc.args[0]),
+                        self.start_times.pop(proc.pid),
+                        time.perf_counter(),
+                        tid=proc.pid,
+                        args={'cmd': proc.args, 'returncode': returncode}
+                    )
+                return returncode
+
+    def start(self, cmd, input=None):  # pylint: disable=redefined-builtin
+        '''
+        Start a supervised process with optional input and return it.
+        '''
+        if input is None:
+            return self.popen(cmd)
+        proc = self.popen(cmd, stdin=subprocess.PIPE)
+        try:
+            proc.stdin.write(input)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return proc
+
+    def run(self, cmd, input=None):  # pylint: disable=redefined-builtin
+        '''
+        Run a supervised process with optional input and return its exit code.
+        '''
+        return self.wait(self.start(cmd, input=input))
+
+    def raise_if_interrupted(self, output_dir, filenames):
+        '''
+        Raise DownloadInterrupted with a report of the completed files if a
+        signal has been received. A file is considered complete if it exists and
+        has no Aria2 control file.
+        '''
+        if self.received is None:
+            return
+        if not output_dir:
+            output_dir = '.'
+        complete = list()
+        incomplete = list()
+        for filename in filenames:
+            path = os.path.join(output_dir, filename)
+            if os.path.exists(path) and not os.path.exists(path + ARIA2_EXT):
+                complete.append(filename)
+            else:
+                incomplete.append(filename)
+        for filename in complete:
+            logging.info('completed: %s', filename)
+        for filename in incomplete:
+            logging.info('incomplete: %s', filename)
+        raise DownloadInterrupted(
+            'interrupted by {}: {:d} of {:d} file(s) completed in {}\n'
+            'Run the same command again to resume the download.'.format(
+                signal.Signals(self.received).name,
+                len(complete),
+                len(complete) + len(incomplete),
+                output_dir
+            )
+        )
+
+
+# -------------------------------- Powerpill --------------------------------- #
+
+class Powerpill():
+    '''
+    Main program class.
+    '''
+
+    def __init__(self, pargs, pm2ml_pargs=None, ttl=pm2ml.DEFAULT_TTL, profiler=None):
+
+        self.pargs = pargs
+        self.profiler = profiler or Profiler()
+        with self.profiler.phase('configuration'):
+            self.conf = Config(pargs['powerpill_config'])
+            self.pacman_conf = get_pacman_conf(pargs, self.conf)
+        self.db_lock = None
+        # The round-trip time is measured at most once per run.
+        self.rtt = None
+        if pm2ml_pargs is None:
+            pm2ml_pargs = pm2ml.parse_args([])
+        with self.profiler.phase('initialize ALPM'):
+            self.pm2ml = pm2ml.Pm2ml(pm2ml_pargs, pacman_conf=self.pacman_conf)
+
+    def get_rsync_servers(self, repo):
+        '''
+        Return the Rsync servers for the given repository as a tuple. Servers
+        configured for the repository take precedence over the general servers,
+        which are only used for the official repositories.
+        '''
+        servers = self.conf.get('rsync/repos/{}/servers'.format(repo))
+        if servers is None and repo in OFFICIAL_REPOSITORIES:
+            servers = self.conf.get('rsync/servers')
+        return tuple(servers or ())
+
+    # rsync has a hard limit of 1000 arguments (someone actually hit this and
+    # reported it), so this may return multiple commands to handle all arguments.
+    def download_queue_to_rsync_cmds(
+        self,
+        rsync_server,
+        queue,
+        output_dir=None,
+    ):  # pylint: disable=too-many-locals
+        '''
+        Convert a download queue to an rsync command list.
+        '''
+        cmd = [self.conf.get('rsync/path'), '-aL'] + self.conf.get('rsync/args')
+
+        url = urllib.parse.urlparse(rsync_server)
+        host = url.netloc
+        # [1:] to remove initial slash
+        path = url.path[1:].replace('$arch', self.pacman_conf.options['Architecture'])
+
+        host_added = False
+
+        if not output_dir:
+            output_dir = '.'
+
+        args = list()
+
+        for db, sigs, files in queue.dbs:  # pylint: disable=invalid-name
+            if files:
+                db_ext = FILES_EXT
+            else:
+                db_ext = DB_EXT
+            db_path = '::' + os.path.join(path.replace('$repo', db.name), db.name + db_ext)
+            if not host_added:
+                args.append(host + db_path)
+                host_added = True
+            else:
+                args.append(db_path)
+            if sigs:
+                args.append(db_path + SIG_EXT)
+
+        for pkg, _urls, sigs in queue.sync_pkgs:
+            pkg_path = '::' + os.path.join(path.replace('$repo', pkg.db.name), pkg.filename)
+            if not host_added:
+                args.append(host + pkg_path)
+                host_added = True
+            else:
+                args.append(pkg_path)
+            if sigs:
+                args.append(pkg_path + SIG_EXT)
+
+        # handle the hard limit
+        rsync_limit = 1000
+        arg_limit = rsync_limit - (len(cmd) + 1)
+        assert arg_limit > 0, 'rsync command construction failed due to argument limit'
+        while args:
+            yield cmd + args[:arg_limit] + [output_dir]
+            args = args[arg_limit:]
+
+    def get_pm2ml_pkg_download_args(self, dpath=None, ignore=True):
+        '''
+        Iterate over pm2ml options for downloading packages.
+        '''
+        if dpath:
+            yield '-o'
+            yield dpath
+        for opt in ('sysupgrade', 'verbose', 'debug'):
+            for _ in range(self.pargs[opt]):
+                yield '--' + opt
+        for opt in self.pargs['pm2ml_options']:
+            yield opt
+        if ignore:
+            for pkg in self.pacman_conf.options['IgnorePkg']:
+                yield '--ignore'
+                yield pkg
+            for grp in self.pacman_conf.options['IgnoreGroup']:
+                yield '--ignoregroup'
+                yield grp
+        if self.conf.get('powerpill/select'):
+            yield '--select'
+        for arg in self.pargs['args']:
+            yield arg
+
+    def get_resolution_cache(self):
+        '''
+        Return the resolution cache.
+        '''
+        return ResolutionCache(
+            os.path.join(self.conf.get('powerpill/cache dir'), RESOLUTION_CACHE_FILE)
+        )
+
+    def get_resolution_cache_key(self, pm2ml_args):
+        '''
+        Return the resolution cache key for the pm2ml arguments or None if the
+        resolution cache is disabled.
+
+        The cache is also bypassed if package groups are selected interactively
+        because the cached queue would otherwise repeat the previous selection.
+        '''
+        if not self.conf.get('powerpill/resolution cache'):
+            return None
+        if '--select' in pm2ml_args and self.has_group_targets():
+            logging.debug('not using the resolution cache for package groups')
+            return None
+        return ResolutionCache.get_key(
+            self.pacman_conf,
+            self.pargs['pacman_config'],
+            pm2ml_args
+        )
+
+    def has_group_targets(self):
+        '''
+        Return True if any of the targets is a package group in a sync database.
+        '''
+        targets = set(self.pargs['args'])
+        if not targets:
+            return False
+        for db in self.pm2ml.handle.get_syncdbs():
+            groups = set(name for name, _pkgs in db.grpcache)
+            for target in targets:
+                # Targets may be qualified with the repository.
+                repo, sep, name = target.rpartition('/')
+                if name in groups and (not sep or repo == db.name):
+                    return True
+        return False
+
+    @profiled('resolution')
+    def resolve(self, pm2ml_pargs, cache_key=None):
+        '''
+        Resolve the targets specified by the parsed pm2ml arguments and return
+        the download queue. If a cache key is given, the result is retrieved
+        from and stored in the resolution cache.
+        '''
+        if cache_key is not None:
+            resolution_cache = self.get_resolution_cache()
+            download_queue = resolution_cache.get(cache_key, self.pm2ml.handle)
+            if download_queue is not None:
+                logging.info('using cached dependency resolution')
+                return download_queue
+
+        sync_pkgs, sync_deps, \
+            _aur_pkgs, _aur_deps, \
+            _not_found, _unknown_deps, _orphans = \
+            self.pm2ml.resolve_targets_from_arguments(pm2ml_pargs)
+
+        download_queue = \
+            self.pm2ml.build_download_queue(
+                pm2ml_pargs,
+                sync_pkgs | sync_deps
+            )
+
+        if cache_key is not None:
+            resolution_cache.put(cache_key, download_queue)
+        return download_queue
+
+    @profiled('peers')
+    def get_peer_urls(self, filenames):
+        '''
+        Query the configured and discovered peers for the given files and return
+        a dict mapping filenames to lists of peer URLs.
+        '''
+        timeout = self.conf.get('peers/timeout')
+        peers = list(self.conf.get('peers/servers'))
+        if self.conf.get('peers/discover'):
+            try:
+                for peer in discover_peers(self.conf.get('peers/port'), timeout):
+                    if peer not in peers:
+                        peers.append(peer)
+            except OSError as err:
+                logging.warning('peer discovery failed [%s]', err)
+        peer_urls = collections.defaultdict(list)
+        if not peers or not filenames:
+            return peer_urls
+
+        def query(peer):
+            try:
+                return peer, query_peer(peer, filenames, timeout)
+            except (OSError, ValueError) as err:
+                logging.warning('failed to query peer %s [%s]', peer, err)
+                return peer, set()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(peers), 16)) as executor:
+            for peer, available in executor.map(query, peers):
+                for filename in available:
+                    peer_urls[filename].append(
+                        peer.rstrip('/') + '/' + urllib.parse.quote(filename)
+                    )
+        logging.info('%d file(s) available from peers', len(peer_urls))
+        return peer_urls
+
+    def serve_peers(self):
+        '''
+        Serve the package cache to peers.
+        '''
+        PeerServer(
+            self,
+            self.conf.get('peers/port'),
+            address=self.conf.get('peers/address')
+        ).serve_forever()
+
+    def download(
+        self,
+        pm2ml_args,
+        dbs=False,
+        force=False,
+        download_queue=None,
+        plan=False
+    ):  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+        '''
+        Download files specified by pm2ml arguments. If a download queue is
+        given, it is used instead of resolving the targets in the arguments.
+
+        If plan is True, nothing is copied or transferred and the list of routes
+        is returned instead. Each route is a dict with the name, the backend,
+        the size in bytes and the host of a file.
+        '''
+#     for pkg in self.pacman_conf.options['IgnorePkg']:
+#       pm2ml_args.extend(('--ignore', pkg))
+#     for grp in self.pacman_conf.options['IgnoreGroup']:
+#       pm2ml_args.extend(('--ignoregroup', grp))
+#     if self.conf.get('powerpill/select'):
+#       pm2ml_args.append('--select')
+        if dbs:
+            #       pm2ml_args.append('--preference')
+            reflect = self.conf.get('powerpill/reflect databases')
+        else:
+            reflect = True
+        # This must be added last.
+        if reflect and self.conf.get('reflector/args'):
+            pm2ml_args += ['--reflector'] + self.conf.get('reflector/args')
+        pm2ml_pargs = pm2ml.parse_args(pm2ml_args)
+        if download_queue is None:
+            if dbs:
+                cache_key = None
+            else:
+                cache_key = self.get_resolution_cache_key(pm2ml_args)
+            download_queue = self.resolve(pm2ml_pargs, cache_key=cache_key)
+
+        # Rsync queues grouped by their server lists.
+        rsync_queues = collections.defaultdict(pm2ml.DownloadQueue)
         metalink_queue = pm2ml.DownloadQueue()
 
         output_dir = pm2ml_pargs.output_dir
-        if output_dir:
+        if output_dir and not plan:
             # A FileExistsError will be raised even with exists_ok=True if the mode
             # does not match the umask-masked mode.
             try:
                 os.makedirs(output_dir, exist_ok=True)
             except FileExistsError:
                 pass
-        pushd = XCGF.Pushd(output_dir)
 
-        rsync_servers = self.conf.get('rsync/servers')
         pacserve_server = self.conf.get('pacserve/server')
+        peer_urls = dict()
+        queued = dict()
+        routes = list()
+
+        def add_route(name, backend, size, url=None):
+            routes.append({
+                'name': name,
+                'backend': backend,
+                'bytes': size,
+                'host': get_url_host(url) if url else None,
+            })
 
         if dbs:
             for db, sigs, files in download_queue.dbs:
@@ -624,70 +2624,72 @@ class Powerpill():
                     db_ext = FILES_EXT
                 else:
                     db_ext = DB_EXT
+                db_name = db.name + db_ext
+                # The size of the previous database is the best estimate.
+                size = get_file_sizes(output_dir, (db_name,))[db_name]
                 is_local = False
                 for server in db.servers:
                     if server[:7] == 'file://':
-                        db_name = db.name + db_ext
                         local_path = os.path.join(server[7:], db_name)
                         output_path = os.path.join(output_dir, db_name)
-                        try:
-                            XCGF.copy_file_and_maybe_sig(local_path, output_path, sig=sigs)
-                        except FileNotFoundError:
-                            continue
-                        else:
+                        if copy_local_file(local_path, output_path, sig=sigs, dry_run=plan):
                             is_local = True
+                            add_route(db_name, 'file', os.path.getsize(local_path))
                             break
                 if is_local:
                     continue
-                if rsync_servers and db.name in OFFICIAL_REPOSITORIES:
-                    rsync_queue.add_db(db, sigs, files)
+                rsync_servers = self.get_rsync_servers(db.name)
+                if rsync_servers:
+                    rsync_queues[rsync_servers].add_db(db, sigs, files)
+                    add_route(db_name, 'rsync', size, rsync_servers[0])
                 else:
                     metalink_queue.add_db(db, sigs, files)
+                    add_route(db_name, 'aria2', size, db.servers[0] if db.servers else None)
 
         else:
-            queued = dict()
             for pkg, urls, sigs in download_queue.sync_pkgs:
                 is_local = False
                 for server in urls:
                     if server[:7] == 'file://':
                         local_path = server[7:]
                         output_path = os.path.join(output_dir, pkg.filename)
-                        try:
-                            XCGF.copy_file_and_maybe_sig(local_path, output_path, sig=sigs)
-                        except FileNotFoundError:
-                            continue
-                        else:
+                        if copy_local_file(local_path, output_path, sig=sigs, dry_run=plan):
                             is_local = True
+                            add_route(pkg.filename, 'file', pkg.size)
                             break
                 if not is_local:
                     queued[pkg.filename] = pkg
 
             found = None
             if pacserve_server:
-                queued_names = sorted(queued)
-                found = search_pacserve(pacserve_server, queued_names)
-                # The local pacserve server likely points to the same cache
-                # directory. The incoming file would be written to the same file
-                # that Pacserve is reading, thus truncating the file. Avoid this
-                # by skipping the file if it has a valid checksum, otherwise remove
-                # it and requery Pacserve.
-                if found is not None:
-                    unlinked = False
-                    for filename, found_url in found.items():
-                        if found_url.startswith(pacserve_server):
-                            db_sha256sum = queued[filename].sha256sum
-                            for cdir in self.pacman_conf.options['CacheDir']:
-                                file_cachepath = os.path.join(cdir, filename)
-                                cache_sha256 = XCGF.get_checksum(file_cachepath, typ='sha256')
-                                if cache_sha256 is None:
-                                    continue
-                                if cache_sha256 != db_sha256sum:
-                                    os.unlink(file_cachepath)
-                                    unlinked = True
-                                    continue
-                                break
-                    if unlinked:
-                        found = search_pacserve(pacserve_server, queued_names)
+                with self.profiler.phase('pacserve'):
+                    queued_names = sorted(queued)
+                    found = search_pacserve(pacserve_server, queued_names)
+                    # The local pacserve server likely points to the same cache
+                    # directory. The incoming file would be written to the same file
+                    # that Pacserve is reading, thus truncating the file. Avoid this
+                    # by skipping the file if it has a valid checksum, otherwise remove
+                    # it and requery Pacserve.
+                    if found is not None and not plan:
+                        unlinked = False
+                        for filename, found_url in found.items():
+                            if found_url.startswith(pacserve_server):
+                                db_sha256sum = queued[filename].sha256sum
+                                for cdir in self.pacman_conf.options['CacheDir']:
+                                    file_cachepath = os.path.join(cdir, filename)
+                                    cache_sha256 = XCGF.get_checksum(file_cachepath, typ='sha256')
+                                    if cache_sha256 is None:
+                                        continue
+                                    if cache_sha256 != db_sha256sum:
+                                        os.unlink(file_cachepath)
+                                        unlinked = True
+                                        continue
+                                    break
+                        if unlinked:
+                            found = search_pacserve(pacserve_server, queued_names)
+
+            if self.conf.get('peers/servers') or self.conf.get('peers/discover'):
+                peer_urls = self.get_peer_urls(sorted(queued))
 
         for pkg, urls, sigs in download_queue.sync_pkgs:
             use_pacserve = True
@@ -696,25 +2698,264 @@ class Powerpill():
             except (KeyError, TypeError):
                 use_pacserve = False
 
-            if not use_pacserve \
-                    and not self.conf.get('rsync/db only') \
-                    and rsync_servers \
-                    and pkg.db.name in OFFICIAL_REPOSITORIES:
-                rsync_queue.add_sync_pkg(pkg, urls, sigs)
+            # Peers are listed first so that they are preferred over mirrors.
+            use_peers = not use_pacserve and pkg.filename in peer_urls
+            if use_peers:
+                urls = peer_urls[pkg.filename] + list(urls)
+
+            if use_pacserve or use_peers or self.conf.get('rsync/db only'):
+                rsync_servers = ()
+            else:
+                rsync_servers = self.get_rsync_servers(pkg.db.name)
+            if rsync_servers:
+                rsync_queues[rsync_servers].add_sync_pkg(pkg, urls, sigs)
+                backend = 'rsync'
+                url = rsync_servers[0]
             else:
                 metalink_queue.add_sync_pkg(pkg, urls, sigs)
+                if use_pacserve:
+                    backend = 'pacserve'
+                elif use_peers:
+                    backend = 'peers'
+                else:
+                    backend = 'aria2'
+                url = urls[0] if urls else None
+            # Local copies have already been routed.
+            if pkg.filename in queued:
+                add_route(pkg.filename, backend, pkg.size, url)
 
         metalink_queue.aur_pkgs = download_queue.aur_pkgs
 
+        # Only Aria2 follows the order of its input. Rsync sorts its file list.
+        metalink_queue.sync_pkgs = order_sync_pkgs(
+            metalink_queue.sync_pkgs,
+            self.conf.get('powerpill/download order')
+        )
+
+        if plan:
+            return routes
+
+        if not dbs and self.conf.get('powerpill/verify signatures'):
+            verifier = self.get_signature_verifier(
+                output_dir,
+                metalink_queue,
+                *rsync_queues.values()
+            )
+        else:
+            verifier = None
+
+        with ProcessSupervisor(
+            self.conf.get('powerpill/signal timeout'),
+            profiler=self.profiler
+        ) as supervisor:
+            filenames = list(get_download_queue_filenames(metalink_queue, *rsync_queues.values()))
+            if verifier is not None:
+                supervisor.poll_callbacks.append(verifier.poll)
+                self.prefetch_signatures(supervisor, metalink_queue, output_dir)
+            if not dbs and self.conf.get('powerpill/staging dir'):
+                staged_queue = self.split_staged_queue(metalink_queue, output_dir)
+            else:
+                staged_queue = None
+            transfer_args = (supervisor, metalink_queue, rsync_queues, output_dir)
+            transfer_kwargs = {
+                'dbs': dbs,
+                'force': force,
+                'set_preference': bool(peer_urls),
+            }
+            if staged_queue and supervisor.received is None:
+                # The staged and the spilled packages are downloaded at once.
+                with tempfile.TemporaryDirectory(
+                    prefix='powerpill-',
+                    dir=self.conf.get('powerpill/staging dir')
+                ) as staging_dir:
+                    try:
+                        self.transfer(
+                            *transfer_args,
+                            staged=(staged_queue, staging_dir),
+                            **transfer_kwargs
+                        )
+                    finally:
+                        self.unstage(staging_dir, output_dir, staged_queue)
+            elif supervisor.received is None:
+                self.transfer(*transfer_args, **transfer_kwargs)
+            if verifier is not None:
+                with self.profiler.phase('signature verification'):
+                    invalid = verifier.finish()
+            else:
+                invalid = None
+            supervisor.raise_if_interrupted(output_dir, filenames)
+        if invalid:
+            raise PowerpillError(
+                'removed {:d} package(s) with bad signatures:\n{}'.format(
+                    len(invalid),
+                    '\n'.join(invalid)
+                )
+            )
+
+    def split_staged_queue(self, queue, output_dir):
+        '''
+        Move packages from the queue to a new queue for downloading to the
+        staging directory until the staging budget is exhausted, and return the
+        new queue. Packages that are already present in the output directory are
+        left in the queue so that Aria2 can check or resume them.
+
+        If no budget is configured, a fraction of the free space of the staging
+        directory is used (see STAGING_BUDGET_FRACTION).
+        '''
+        staging_dir = self.conf.get('powerpill/staging dir')
+        if not os.path.isdir(staging_dir):
+            raise ConfigError('staging dir is not a directory: {}'.format(staging_dir))
+        budget = self.conf.get('powerpill/staging budget')
+        if budget is None:
+            budget = int(shutil.disk_usage(staging_dir).free * STAGING_BUDGET_FRACTION)
+        staged_queue = pm2ml.DownloadQueue()
+        sync_pkgs = list()
+        for pkg, urls, sigs in queue.sync_pkgs:
+            if pkg.size <= budget \
+                    and not os.path.exists(os.path.join(output_dir or '.', pkg.filename)):
+                staged_queue.add_sync_pkg(pkg, urls, sigs)
+                budget -= pkg.size
+            else:
+                sync_pkgs.append((pkg, urls, sigs))
+        queue.sync_pkgs = sync_pkgs
+        logging.debug(
+            'staging %d package(s), %d spilled to the cache',
+            len(staged_queue.sync_pkgs),
+            len(sync_pkgs)
+        )
+        return staged_queue
+
+    @profiled('unstage')
+    def unstage(self, staging_dir, output_dir, queue):
+        '''
+        Move the downloads in the queue from the staging directory to the output
+        directory. Packages are moved if they have the expected size. Partial
+        downloads are moved along with their Aria2 control files so that they
+        are resumed in the output directory. Partial downloads without a control
+        file, e.g. after Aria2 was killed, are discarded.
+        '''
+        output_dir = output_dir or '.'
+        for pkg, _urls, _sigs in queue.sync_pkgs:
+            path = os.path.join(staging_dir, pkg.filename)
+            output_path = os.path.join(output_dir, pkg.filename)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            if os.path.exists(path + ARIA2_EXT):
+                # Move the control file first so that a partial package is never
+                # left in the output directory without it.
+                move_file(path + ARIA2_EXT, output_path + ARIA2_EXT)
+                move_file(path, output_path)
+            elif size == pkg.size:
+                move_file(path, output_path)
+                if is_complete(path + SIG_EXT):
+                    move_file(path + SIG_EXT, output_path + SIG_EXT)
+            else:
+                logging.warning('discarding incomplete download: %s', pkg.filename)
+
+    def get_signature_verifier(self, output_dir, *queues):
+        '''
+        Return a SignatureVerifier for the signed packages in the queues.
+        '''
+        checked = get_package_signature_checks(self.pargs['pacman_config'])
+        filenames = list()
+        for queue in queues:
+            for pkg, _urls, sigs in queue.sync_pkgs:
+                if sigs and checked.get(pkg.db.name, True):
+                    filenames.append(pkg.filename)
+        cmd = [
+            self.conf.get('pacman/gpg path'),
+            '--homedir', self.pacman_conf.options['GPGDir'],
+            '--batch',
+            '--status-fd', '1',
+            '--verify',
+        ]
+        return SignatureVerifier(
+            cmd,
+            output_dir,
+            filenames,
+            os.path.join(self.conf.get('powerpill/cache dir'), SIGNATURES_FILE),
+            jobs=self.conf.get('powerpill/verification jobs')
+        )
+
+    @profiled('signatures')
+    def prefetch_signatures(self, supervisor, queue, output_dir):
+        '''
+        Download the signatures of the packages in the metalink queue before
+        the packages so that each package can be verified as soon as it is
+        complete. Signatures that were downloaded are removed from the queue.
+        '''
+        lines = list()
+        for pkg, urls, sigs in queue.sync_pkgs:
+            if not sigs:
+                continue
+            sig_urls = [url + SIG_EXT for url in urls if url[:7] != 'file://']
+            if sig_urls:
+                # Aria2 input file format: tab-separated mirrors of one file,
+                # followed by indented options.
+                lines.append('\t'.join(sig_urls))
+                lines.append('  out=' + pkg.filename + SIG_EXT)
+        if not lines:
+            return
+        aria2_cmd = [
+            self.conf.get('aria2/path'),
+            '--input-file=-',
+        ] + self.conf.get('aria2/args') + [
+            '--split=1',
+        ]
+        with XCGF.Pushd(output_dir):
+            supervisor.run(aria2_cmd, input='\n'.join(lines + ['']).encode())
+        sync_pkgs = list()
+        for pkg, urls, sigs in queue.sync_pkgs:
+            if sigs and is_complete(os.path.join(output_dir or '.', pkg.filename + SIG_EXT)):
+                sigs = False
+            sync_pkgs.append((pkg, urls, sigs))
+        queue.sync_pkgs = sync_pkgs
+
+    @profiled('transfer')
+    def transfer(
+        self,
+        supervisor,
+        metalink_queue,
+        rsync_queues,
+        output_dir,
+        dbs=False,
+        force=False,
+        set_preference=False,
+        staged=None
+    ):  # pylint: disable=too-many-arguments,too-many-branches,too-many-locals
+        '''
+        Transfer the files in the Aria2 and Rsync download queues. The Rsync
+        queues are mapped to the servers from which they are downloaded. All
+        processes are started through the given supervisor. Metalink
+        preferences are always set for databases and optionally for packages.
+
+        If staged is a (queue, directory) pair, the packages in that queue are
+        downloaded to that directory by a second Aria2 process that runs at the
+        same time as the one for the metalink queue.
+        '''
+        pushd = XCGF.Pushd(output_dir)
+        aria2_queues = list()
+        if staged is not None:
+            aria2_queues.append((staged[0], staged[1], False))
         if metalink_queue:
-            metalink = str(
-                pm2ml.download_queue_to_metalink(metalink_queue, set_preference=dbs)
-            ).encode()
+            aria2_queues.append((metalink_queue, output_dir, dbs))
+
+        aria2_procs = list()
+        for queue, dpath, queue_dbs in aria2_queues:
+            with self.profiler.phase('metalink generation'):
+                metalink = str(
+                    pm2ml.download_queue_to_metalink(
+                        queue,
+                        set_preference=(queue_dbs or set_preference)
+                    )
+                ).encode()
             aria2_cmd = [
                 self.conf.get('aria2/path'),
                 '--metalink-file=-',
             ] + self.conf.get('aria2/args')
-            if dbs:
+            if queue_dbs:
                 aria2_cmd += [
                     '--split=1',
                 ]
@@ -725,27 +2966,55 @@ class Powerpill():
                     '--allow-overwrite=true',
                     '--conditional-get=false',
                 ]
-            elif dbs:
+            elif queue_dbs:
                 aria2_cmd += [
                     '--continue=false',
                     '--remove-control-file=true',
                     '--allow-overwrite=true',
                     '--conditional-get=true',
                 ]
-            with pushd:
-                aria2c_p = subprocess.Popen(aria2_cmd, stdin=subprocess.PIPE)
-                aria2c_p.communicate(input=metalink)
+            # Later options override the configured ones.
+            if not queue_dbs and self.conf.get('aria2/auto tune'):
+                aria2_cmd += self.get_aria2_tuning_args(queue)
+            filenames = list(get_download_queue_filenames(queue))
+            sizes = get_file_sizes(dpath, filenames)
+            with XCGF.Pushd(dpath):
+                proc = supervisor.start(aria2_cmd, input=metalink)
+            aria2_procs.append((proc, queue, dpath, sizes, time.monotonic()))
+
+        aria2_es = list()
+        for proc, queue, dpath, sizes, start in aria2_procs:
+            aria2_es.append(supervisor.wait(proc))
+            self.record_throughput(
+                get_primary_hosts(queue),
+                dpath,
+                sizes,
+                time.monotonic() - start
+            )
+        if supervisor.received is not None:
+            return
 
-        if rsync_queue:
+        for rsync_servers, rsync_queue in rsync_queues.items():
             for rsync_server in rsync_servers:
                 rsync_cmds = self.download_queue_to_rsync_cmds(
                     rsync_server,
                     rsync_queue,
                     output_dir=output_dir
                 )
+                filenames = list(get_download_queue_filenames(rsync_queue))
+                sizes = get_file_sizes(output_dir, filenames)
+                start = time.monotonic()
                 with pushd:
-                    rsync_ps = tuple(subprocess.Popen(cmd) for cmd in rsync_cmds)
-                    es = tuple(p.wait() for p in rsync_ps)
+                    rsync_ps = tuple(supervisor.popen(cmd) for cmd in rsync_cmds)
+                    es = tuple(supervisor.wait(p) for p in rsync_ps)
+                self.record_throughput(
+                    (get_url_host(rsync_server),),
+                    output_dir,
+                    sizes,
+                    time.monotonic() - start
+                )
+                if supervisor.received is not None:
+                    return
                 if all((e == 0) for e in es):
                     # Success
                     break
@@ -768,37 +3037,161 @@ class Powerpill():
                     self.conf.get('aria2/path'),
                     '--metalink-file=-',
                 ] + self.conf.get('aria2/args')
+                if not dbs and self.conf.get('aria2/auto tune'):
+                    aria2_cmd2 += self.get_aria2_tuning_args(rsync_queue)
                 with pushd:
-                    aria2c_p2 = subprocess.Popen(aria2_cmd2, stdin=subprocess.PIPE)
-                    aria2c_p2.communicate(input=metalink2)
-                    e = aria2c_p2.wait()
+                    e = supervisor.run(aria2_cmd2, input=metalink2)
+                if supervisor.received is not None:
+                    return
                 if e not in ARIA2_DOWNLOAD_ERROR_EXIT_CODES:
                     raise PowerpillError('aria2c exited with {:d}'.format(e))
 
-        if metalink_queue:
-            e = aria2c_p.wait()
-            if e not in ARIA2_DOWNLOAD_ERROR_EXIT_CODES:
-                raise PowerpillError('aria2c exited with {:d}'.format(e))
+        for aria2_e in aria2_es:
+            if aria2_e not in ARIA2_DOWNLOAD_ERROR_EXIT_CODES:
+                raise PowerpillError('aria2c exited with {:d}'.format(aria2_e))
 
-    def run_pacman(self, args=None):
+    @profiled('aria2 tuning')
+    def get_aria2_tuning_args(self, queue):
         '''
-        Run Pacman (or equivalent) with the given arguments.
+        Return Aria2 arguments tuned for the packages in the queue from the file
+        sizes, the recorded throughput of the preferred hosts and the round-trip
+        time. The round-trip time is measured once per run to the first mirrors
+        of the largest package and smoothed with the value stored for the
+        network, which is also used if the measurement fails. Return an empty
+        list if the throughput is unknown.
         '''
-        if args is None:
-            args = list(unparse_args(self.pargs))
-        return subprocess.call([self.conf.get('pacman/path')] + args)
+        if not queue.sync_pkgs:
+            return list()
+        history = self.get_throughput_history()
+        throughputs = [
+            t for t in (history.get(h) for h in get_primary_hosts(queue)) if t
+        ]
+        if not throughputs:
+            return list()
+        throughput = sum(throughputs) / len(throughputs)
+
+        if self.rtt is None:
+            network_id = get_network_id()
+            path = os.path.join(self.conf.get('powerpill/cache dir'), ARIA2_TUNING_FILE)
+            state = load_state(path)
+            if not isinstance(state, dict):
+                state = dict()
+            rtt = None
+            largest = max(queue.sync_pkgs, key=lambda entry: entry[0].size)
+            for url in largest[1][:RTT_PROBES]:
+                rtt = measure_rtt(url)
+                if rtt is not None:
+                    break
+            previous_rtt = state.get(network_id, dict()).get('rtt')
+            if rtt is None:
+                rtt = previous_rtt or DEFAULT_RTT
+            else:
+                if previous_rtt:
+                    rtt = previous_rtt + THROUGHPUT_WEIGHT * (rtt - previous_rtt)
+                state[network_id] = {
+                    'rtt': rtt,
+                    'time': time.time(),
+                }
+                save_state(path, state)
+            logging.debug('round-trip time for %s: %.3f s', network_id, rtt)
+            self.rtt = rtt
+
+        options = get_aria2_tuning(
+            [pkg.size for pkg, _urls, _sigs in queue.sync_pkgs],
+            throughput,
+            self.rtt
+        )
+        logging.info(
+            'aria2 tuning (%.0f B/s, %.3f s RTT): %s',
+            throughput, self.rtt, options
+        )
+        return ['--{}={}'.format(k, v) for k, v in sorted(options.items())]
 
-    def refresh_databases(self, files=False, pm2ml_passthrough_args={}):
+    def get_throughput_history(self):
         '''
-        Download Pacman sync databases.
+        Return the throughput history.
         '''
-        pacman_conf = self.pacman_conf
-        sync_dir = os.path.join(pacman_conf.options['DBPath'], 'sync')
+        return ThroughputHistory(
+            os.path.join(self.conf.get('powerpill/cache dir'), THROUGHPUT_FILE)
+        )
+
+    def record_throughput(self, hosts, output_dir, sizes, seconds):
+        '''
+        Record the throughput of a transfer from the growth of the files in the
+        output directory.
+        '''
+        new_sizes = get_file_sizes(output_dir, sizes)
+        nbytes = sum(max(new_sizes[f] - sizes[f], 0) for f in sizes)
+        if nbytes < THROUGHPUT_MIN_BYTES:
+            return
+        history = self.get_throughput_history()
+        history.record(hosts, nbytes, seconds)
+        history.save()
+
+    def plan(self):
+        '''
+        Return the transfer plan for the current operation. See download().
+        '''
+        history = self.get_throughput_history()
+        plan = dict()
+        if self.pargs['refresh'] > 0:
+            files = bool(self.pargs['files'] and not self.pargs['sync'])
+            routes = self.download(self.get_db_pm2ml_args(files=files), dbs=True, plan=True)
+            plan['databases'] = summarize_routes(routes, history)
+        if self.pargs['sync'] and (self.pargs['sysupgrade'] > 0 or self.pargs['args']):
+            pm2ml_args = list(self.get_pm2ml_pkg_download_args(dpath=self.get_cachedir()))
+            routes = self.download(pm2ml_args, plan=True)
+            plan['packages'] = summarize_routes(routes, history)
+        sections = list(plan.values())
+        for key in ('bytes', 'estimated seconds', 'unestimated bytes'):
+            plan[key] = sum(section[key] for section in sections)
+        return plan
+
+    @profiled('pacman')
+    def run_pacman(self, args=None):
+        '''
+        Run Pacman (or equivalent) with the given arguments. Large target lists
+        of sync operations are passed via stdin to avoid exceeding the maximum
+        command-line length.
+        '''
+        pacman_cmd = [self.conf.get('pacman/path')]
+        if args is not None:
+            return subprocess.call(pacman_cmd + args)
+        targets = self.pargs['args']
+        if not (self.pargs['sync'] or self.pargs['files']) \
+                or sum(len(t) + 1 for t in targets) <= PACMAN_ARGV_TARGETS_MAX:
+            return subprocess.call(pacman_cmd + list(unparse_args(self.pargs)))
+        # Pacman reads the targets from stdin when "-" is given and then
+        # reopens the terminal for any prompts.
+        args = list(unparse_args(self.pargs, targets=False)) + ['-']
+        proc = subprocess.Popen(pacman_cmd + args, stdin=subprocess.PIPE)
+        try:
+            for i in range(0, len(targets), 1000):
+                proc.stdin.write(''.join(t + '\n' for t in targets[i:i + 1000]).encode())
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return proc.wait()
+
+    def get_db_pm2ml_args(self, files=False):
+        '''
+        Return the pm2ml arguments for downloading the sync databases.
+        '''
+        sync_dir = os.path.join(self.pacman_conf.options['DBPath'], 'sync')
         pm2ml_args = ['-yso', sync_dir]
         if files:
             pm2ml_args.append('--files')
         pm2ml_args.extend(('--' + p for p in ('verbose', 'debug') if self.pargs[p] > 0))
         pm2ml_args.extend(self.pargs['pm2ml_options'])
+        return pm2ml_args
+
+    @profiled('refresh databases')
+    def refresh_databases(self, files=False, pm2ml_passthrough_args={}):
+        '''
+        Download Pacman sync databases.
+        '''
+        pacman_conf = self.pacman_conf
+        pm2ml_args = self.get_db_pm2ml_args(files=files)
         db_lockfile = os.path.join(pacman_conf.options['DBPath'], DB_LOCK_FILE)
         db_lock = XCGF.Lockfile(db_lockfile, DB_LOCK_NAME)
         with db_lock:
@@ -807,29 +3200,151 @@ class Powerpill():
         self.pargs['refresh'] = 0
         self.initialize_alpm()
 
+    @profiled('initialize ALPM')
     def initialize_alpm(self):
         '''
         Reinitialize the ALPM database.
         '''
         self.pm2ml.initialize_alpm()
 
-    def download_packages(self):
+    def get_cachedir(self):
+        '''
+        Return the cache directory to which packages are downloaded.
+        '''
+        return self.pacman_conf.options['CacheDir'][0]
+
+    @profiled('download packages')
+    def download_packages(self, download_queue=None):
         '''
         Download files to cache.
         '''
-        pacman_conf = self.pacman_conf
-        cachedir = pacman_conf.options['CacheDir'][0]
+        cachedir = self.get_cachedir()
         pm2ml_args = list(self.get_pm2ml_pkg_download_args(dpath=cachedir))
         cache_lockfile = os.path.join(cachedir, CACHE_LOCK_FILE)
         cache_lock = XCGF.Lockfile(cache_lockfile, CACHE_LOCK_NAME)
         with cache_lock:
-            self.download(pm2ml_args)
+            self.download(pm2ml_args, download_queue=download_queue)
+
+    def resolve_packages(self):
+        '''
+        Resolve the package targets and return the download queue without
+        downloading anything.
+        '''
+        pm2ml_args = list(self.get_pm2ml_pkg_download_args(dpath=self.get_cachedir()))
+        if self.conf.get('reflector/args'):
+            pm2ml_args += ['--reflector'] + self.conf.get('reflector/args')
+        pm2ml_pargs = pm2ml.parse_args(pm2ml_args)
+        return self.resolve(pm2ml_pargs, cache_key=self.get_resolution_cache_key(pm2ml_args))
+
+    def import_sync_databases(self, source):
+        '''
+        Copy the sync databases of another Powerpill instance for all
+        repositories that are configured with the same servers. Return True if
+        all of the repositories were imported.
+        '''
+        source_sync_dir = os.path.join(source.pacman_conf.options['DBPath'], 'sync')
+        sync_dir = os.path.join(self.pacman_conf.options['DBPath'], 'sync')
+        if os.path.abspath(source_sync_dir) == os.path.abspath(sync_dir):
+            return True
+        source_servers = dict(
+            (db.name, db.servers) for db in source.pm2ml.handle.get_syncdbs()
+        )
+        complete = True
+        db_lockfile = os.path.join(self.pacman_conf.options['DBPath'], DB_LOCK_FILE)
+        with XCGF.Lockfile(db_lockfile, DB_LOCK_NAME):
+            for db in self.pm2ml.handle.get_syncdbs():
+                if source_servers.get(db.name) != db.servers:
+                    complete = False
+                    continue
+                for ext in (DB_EXT, FILES_EXT):
+                    for name in (db.name + ext, db.name + ext + SIG_EXT):
+                        try:
+                            shutil.copy2(
+                                os.path.join(source_sync_dir, name),
+                                os.path.join(sync_dir, name)
+                            )
+                        except FileNotFoundError:
+                            continue
+        self.initialize_alpm()
+        return complete
+
+    @profiled('export bundle')
+    def export_bundle(self, path, base=None):
+        '''
+        Download the targets and write them to an offline bundle with the sync
+        databases.
+        '''
+        download_queue = self.resolve_packages()
+        self.download_packages(download_queue=download_queue)
+        cachedir = self.get_cachedir()
+        sync_dir = os.path.join(self.pacman_conf.options['DBPath'], 'sync')
+        files = list()
+        for pkg, _urls, sigs in download_queue.sync_pkgs:
+            if not os.path.exists(os.path.join(cachedir, pkg.filename)):
+                raise PowerpillError('failed to download {}'.format(pkg.filename))
+            files.append(('packages', cachedir, pkg.filename, pkg.sha256sum))
+            if sigs:
+                if not os.path.exists(os.path.join(cachedir, pkg.filename + SIG_EXT)):
+                    raise PowerpillError('failed to download {}'.format(pkg.filename + SIG_EXT))
+                files.append(('packages', cachedir, pkg.filename + SIG_EXT, None))
+        for db in self.pm2ml.handle.get_syncdbs():
+            for ext in (DB_EXT, FILES_EXT):
+                for name in (db.name + ext, db.name + ext + SIG_EXT):
+                    if os.path.exists(os.path.join(sync_dir, name)):
+                        files.append(('sync', sync_dir, name, None))
+        if base is not None:
+            base = read_bundle_manifest(base)
+        manifest = write_bundle(
+            path,
+            files,
+            base=base,
+            chunk_size=self.conf.get('bundle/chunk size'),
+            architecture=self.get_architecture()
+        )
+        if not self.pargs['quiet']:
+            print('exported {:d} file(s) ({:d} omitted) to {}'.format(
+                len(manifest['files']),
+                len(manifest['base files']),
+                ', '.join(manifest['chunks'])
+            ))
+
+    @profiled('import bundle')
+    def import_bundle(self, path):
+        '''
+        Import an offline bundle into the cache and sync database directories.
+        '''
+        cachedir = self.get_cachedir()
+        sync_dir = os.path.join(self.pacman_conf.options['DBPath'], 'sync')
+        cache_lock = XCGF.Lockfile(os.path.join(cachedir, CACHE_LOCK_FILE), CACHE_LOCK_NAME)
+        db_lock = XCGF.Lockfile(
+            os.path.join(self.pacman_conf.options['DBPath'], DB_LOCK_FILE),
+            DB_LOCK_NAME
+        )
+        with cache_lock, db_lock:
+            manifest = extract_bundle(
+                path,
+                {'packages': cachedir, 'sync': sync_dir},
+                architecture=self.get_architecture()
+            )
+        self.initialize_alpm()
+        if not self.pargs['quiet']:
+            print('imported {:d} file(s) from bundle {}'.format(
+                len(manifest['files']),
+                manifest['id']
+            ))
 
+    @profiled('clean')
     def clean(self):
         '''
         Wrapper around clean.
         '''
-        clean(get_cleaning_targets(self.pacman_conf))
+        nfiles, nbytes = clean(
+            get_cleaning_targets(self.pacman_conf),
+            keep=self.conf.get('clean/keep versions'),
+            jobs=self.conf.get('clean/jobs')
+        )
+        if not self.pargs['quiet']:
+            print('removed {:d} file(s), reclaimed {}'.format(nfiles, format_size(nbytes)))
 
     def get_architecture(self):
         '''
@@ -895,31 +3410,361 @@ class Powerpill():
 # ----------------------------------- Main ----------------------------------- #
 
 def get_cleaning_targets(pacman_conf):
-    yield os.path.join(pacman_conf.options['DBPath'], 'sync'), DB_LOCK_FILE
+    '''
+    Iterate over (directory, lock file, lock name, is cache) tuples for all
+    directories to clean.
+    '''
+    dbpath = pacman_conf.options['DBPath']
+    yield os.path.join(dbpath, 'sync'), os.path.join(dbpath, DB_LOCK_FILE), DB_LOCK_NAME, False
     for cachedir in pacman_conf.options['CacheDir']:
-        yield cachedir, CACHE_LOCK_FILE
+        yield cachedir, os.path.join(cachedir, CACHE_LOCK_FILE), CACHE_LOCK_NAME, True
+
+
+def get_stale_packages(entries, keep):
+    '''
+    Return the names of package files and signatures that can be removed from
+    a cache directory when keeping the given number of versions of each
+    package. Signatures without a package are always considered stale.
+    Partial downloads with an Aria2 control file are neither counted as
+    versions nor removed. The entries are a set of file names.
+    '''
+    stale = list()
+    versions = collections.defaultdict(list)
+    for name in entries:
+        if name + ARIA2_EXT in entries:
+            continue
+        match = PKG_FILENAME_REGEX.match(name)
+        if match:
+            versions[(match.group('name'), match.group('arch'))].append(
+                (match.group('version'), name)
+            )
+    if keep is not None:
+        cmp = functools.cmp_to_key(pyalpm.vercmp)
+        for pkgs in versions.values():
+            if len(pkgs) <= keep:
+                continue
+            pkgs.sort(key=lambda pkg: cmp(pkg[0]))
+            for _version, name in pkgs[:len(pkgs) - keep]:
+                stale.append(name)
+                if name + SIG_EXT in entries:
+                    stale.append(name + SIG_EXT)
+    for name in entries:
+        if name.endswith(SIG_EXT) and PKG_FILENAME_REGEX.match(name[:-len(SIG_EXT)]) \
+                and name[:-len(SIG_EXT)] not in entries:
+            stale.append(name)
+    return stale
+
+
+def scan_directory(dir_fd):
+    '''
+    Return the set of the names of Aria2 control files, packages and
+    signatures in an open directory. Other names are not kept.
+    '''
+    names = set()
+    with os.scandir(dir_fd) as scanner:
+        for entry in scanner:
+            name = entry.name
+            if name.endswith(ARIA2_EXT) or name.endswith(SIG_EXT) \
+                    or PKG_FILENAME_REGEX.match(name):
+                names.add(name)
+    return names
+
+
+def unlink_batch(dpath, dir_fd, names):
+    '''
+    Remove a batch of files relative to an open directory descriptor. Return a
+    (number of files, number of bytes) tuple.
+    '''
+    nfiles = 0
+    nbytes = 0
+    for name in names:
+        # Unlinking relative to the directory descriptor avoids resolving the
+        # full path for each file.
+        try:
+            size = os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_size
+            os.unlink(name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            continue
+        except IOError as e:
+            path = os.path.join(dpath, name)
+            logging.error('failed to remove {} [{}]'.format(path, e))
+            raise e
+        else:
+            logging.debug('removed {}'.format(os.path.join(dpath, name)))
+            nfiles += 1
+            nbytes += size
+    return nfiles, nbytes
 
 
-def clean(cleaning_targets):
+def clean_directory(dpath, lockfile, lockname, executor, prune=False, keep=None):
+    '''
+    Remove leftover Aria2 control files from a directory and optionally prune
+    stale packages. The files are removed in batches on the given executor.
+    Return a (number of files, number of bytes) tuple.
+    '''
+    lock = XCGF.Lockfile(lockfile, lockname)
+    logging.info('cleaning {}'.format(dpath))
+    nfiles = 0
+    nbytes = 0
+    with lock:
+        try:
+            dir_fd = os.open(dpath, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            return nfiles, nbytes
+        try:
+            entries = scan_directory(dir_fd)
+            names = list()
+            for name in entries:
+                if name.endswith(ARIA2_EXT):
+                    names.append(name)
+                    # Without its control file, a partial package would pass
+                    # for a complete one, so remove it as well.
+                    partial = name[:-len(ARIA2_EXT)]
+                    if partial in entries and PKG_FILENAME_REGEX.match(partial):
+                        names.append(partial)
+            if prune:
+                names.extend(get_stale_packages(entries, keep))
+            del entries
+            futures = [
+                executor.submit(unlink_batch, dpath, dir_fd, names[i:i + CLEAN_BATCH_SIZE])
+                for i in range(0, len(names), CLEAN_BATCH_SIZE)
+            ]
+            for future in futures:
+                batch_nfiles, batch_nbytes = future.result()
+                nfiles += batch_nfiles
+                nbytes += batch_nbytes
+        finally:
+            os.close(dir_fd)
+    return nfiles, nbytes
+
+
+def clean(cleaning_targets, keep=None, jobs=None):
     '''
     Clean up leftover download files in the sync database and package cache.
+    If keep is not None, only the given number of versions of each package is
+    kept in the cache and orphaned signatures are removed. The directories are
+    scanned in parallel and the files are removed in batches by the given
+    number of threads. Return a (number of files, number of bytes) tuple.
+    '''
+    cleaning_targets = list(cleaning_targets)
+    prune = keep is not None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as unlink_executor, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(cleaning_targets), 1)
+            ) as executor:
+        futures = [
+            executor.submit(
+                clean_directory,
+                dpath,
+                lockfile,
+                lockname,
+                unlink_executor,
+                prune=(prune and is_cache),
+                keep=keep
+            )
+            for dpath, lockfile, lockname, is_cache in cleaning_targets
+        ]
+        results = [future.result() for future in futures]
+    nfiles = sum(r[0] for r in results)
+    nbytes = sum(r[1] for r in results)
+    logging.info('cleaning complete')
+    return nfiles, nbytes
+
+
+def format_size(nbytes):
+    '''
+    Format a number of bytes for display.
+    '''
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024:
+            break
+        nbytes /= 1024
+    else:
+        unit = 'TiB'
+    return '{:.2f} {}'.format(nbytes, unit) if unit != 'B' else '{:d} B'.format(nbytes)
+
+
+def copy_local_file(local_path, output_path, sig=False, dry_run=False):
+    '''
+    Copy a local file and optionally its signature. Return True if the file was
+    found. Nothing is copied for dry runs.
+    '''
+    if dry_run:
+        return os.path.isfile(local_path)
+    try:
+        XCGF.copy_file_and_maybe_sig(local_path, output_path, sig=sig)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def link_or_copy(src, dst):
+    '''
+    Hard-link a file if possible, otherwise copy it.
+    '''
+    if os.path.exists(dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def copy_file_range(src, dst):
+    '''
+    Copy a file with copy_file_range if possible, otherwise with regular reads
+    and writes, in large sequential blocks. The destination is preallocated to
+    avoid fragmentation.
+    '''
+    with open(src, 'rb') as src_handle, open(dst, 'wb') as dst_handle:
+        size = os.fstat(src_handle.fileno()).st_size
+        try:
+            os.posix_fallocate(dst_handle.fileno(), 0, size)
+        except (AttributeError, OSError):
+            pass
+        offset = 0
+        try:
+            while offset < size:
+                n = os.copy_file_range(
+                    src_handle.fileno(),
+                    dst_handle.fileno(),
+                    min(STAGING_BLOCK_SIZE, size - offset)
+                )
+                if n == 0:
+                    break
+                offset += n
+        except AttributeError:
+            pass
+        except OSError as err:
+            if err.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+        src_handle.seek(offset)
+        dst_handle.seek(offset)
+        shutil.copyfileobj(src_handle, dst_handle, STAGING_BLOCK_SIZE)
+        dst_handle.truncate()
+    shutil.copystat(src, dst)
+
+
+def move_file(src, dst):
+    '''
+    Move a file by renaming it, or by copying it to a temporary file next to
+    the destination and renaming that if the destination is on another
+    filesystem.
+    '''
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    tmp_path = os.path.join(
+        os.path.dirname(dst),
+        '.{}.{:d}.tmp'.format(os.path.basename(dst), os.getpid())
+    )
+    try:
+        copy_file_range(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+    os.unlink(src)
+
+
+def run_multiroot(pargs, profiler=None):
     '''
-    for dpath, lockname in cleaning_targets:
-        lockfile = os.path.join(dpath, lockname)
-        lock = XCGF.Lockfile(lockfile, CACHE_LOCK_NAME)
-        logging.info('cleaning {}'.format(dpath))
-        with lock:
-            for path in glob.iglob(os.path.join(dpath, '*' + ARIA2_EXT)):
+    Run a sync operation for multiple installation roots or Pacman
+    configuration files.
+
+    The databases are refreshed once and shared between roots with identical
+    repositories, the download queues of all roots are merged into a single
+    transfer to the cache directory of the first root, and Pacman is then run
+    for each root, in parallel if it does not need to prompt the user.
+    '''
+    powerpills = list()
+    for root in pargs['powerpill_roots']:
+        root_pargs = copy.deepcopy(pargs)
+        root_pargs['powerpill_roots'] = list()
+        if os.path.isfile(root):
+            root_pargs['pacman_config'] = root
+        else:
+            root_pargs['pacman_config_options']['RootDir'] = root
+        powerpills.append(Powerpill(root_pargs, profiler=profiler))
+    primary = powerpills[0]
+
+    if pargs['powerpill_clean']:
+        for powerpill in powerpills:
+            powerpill.clean()
+
+    if pargs['refresh'] > 0:
+        primary.refresh_databases()
+        for powerpill in powerpills[1:]:
+            if powerpill.import_sync_databases(primary):
+                powerpill.pargs['refresh'] = 0
+            else:
+                powerpill.refresh_databases()
+
+    if primary.no_download():
+        if pargs['other_operation']:
+            for powerpill in powerpills:
+                err = powerpill.run_pacman()
+                if err:
+                    return err
+        return 0
+
+    download_queue = pm2ml.DownloadQueue()
+    queued = set()
+    needed = list()
+    for powerpill in powerpills:
+        root_queue = powerpill.resolve_packages()
+        needed.append(root_queue.sync_pkgs)
+        for pkg, urls, sigs in root_queue.sync_pkgs:
+            if pkg.filename not in queued:
+                queued.add(pkg.filename)
+                download_queue.add_sync_pkg(pkg, urls, sigs)
+    logging.info(
+        'downloading %d unique packages for %d roots',
+        len(download_queue.sync_pkgs),
+        len(powerpills)
+    )
+    primary.download_packages(download_queue=download_queue)
+
+    primary_cachedir = primary.get_cachedir()
+    for powerpill, sync_pkgs in zip(powerpills[1:], needed[1:]):
+        cachedir = powerpill.get_cachedir()
+        if os.path.abspath(cachedir) == os.path.abspath(primary_cachedir):
+            continue
+        for pkg, _urls, sigs in sync_pkgs:
+            names = [pkg.filename]
+            if sigs:
+                names.append(pkg.filename + SIG_EXT)
+            for name in names:
                 try:
-                    os.unlink(path)
+                    link_or_copy(
+                        os.path.join(primary_cachedir, name),
+                        os.path.join(cachedir, name)
+                    )
                 except FileNotFoundError:
                     pass
-                except IOError as e:
-                    logging.error('failed to remove {} [{}]'.format(path, e))
-                    raise e
-                else:
-                    logging.debug('removed {}'.format(path))
-    logging.info('cleaning complete')
+
+    if not primary.proceed_to_installation():
+        return 0
+
+    # Interactive Pacman processes cannot share the terminal.
+    if '--noconfirm' in pargs['options'] or '--noconfirm' in pargs['pm2ml_options']:
+        jobs = pargs['powerpill_jobs'] or primary.conf.get('powerpill/parallel installations')
+    else:
+        jobs = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        errs = list(executor.map(lambda p: p.run_pacman(), powerpills))
+    for root, err in zip(pargs['powerpill_roots'], errs):
+        if err:
+            logging.error('pacman exited with %d for %s', err, root)
+    for err in errs:
+        if err:
+            return err
+    return 0
 
 
 def configure_logging(pargs, quiet=False):
@@ -945,7 +3790,31 @@ def main(args=None):
         return 0
 
     configure_logging(pargs)
-    powerpill = Powerpill(pargs)
+
+    with Profiler(pargs['powerpill_profile']) as profiler:
+        return run_operation(pargs, profiler)
+
+
+def run_operation(pargs, profiler):
+    if pargs['powerpill_roots']:
+        if not pargs['sync']:
+            raise ArgumentError('--powerpill-root is only supported for sync operations')
+        for key in ('powerpill_plan', 'powerpill_export', 'powerpill_import'):
+            if pargs[key]:
+                raise ArgumentError('--{} is not supported with --powerpill-root'.format(
+                    key.replace('_', '-')
+                ))
+        return run_multiroot(pargs, profiler=profiler)
+
+    powerpill = Powerpill(pargs, profiler=profiler)
+
+    if pargs['powerpill_serve']:
+        powerpill.serve_peers()
+        return 0
+
+    if pargs['powerpill_plan']:
+        print(json.dumps(powerpill.plan(), indent='  ', sort_keys=True))
+        return 0
 
     # Clean up before doing anything else.
     if pargs['powerpill_clean']:
@@ -953,6 +3822,19 @@ def main(args=None):
         if powerpill.no_operation():
             return 0
 
+    if pargs['powerpill_import']:
+        powerpill.import_bundle(pargs['powerpill_import'])
+        if powerpill.no_operation():
+            return 0
+
+    if pargs['powerpill_export']:
+        if not pargs['sync']:
+            raise ArgumentError('--powerpill-export is only supported for sync operations')
+        if pargs['refresh'] > 0:
+            powerpill.refresh_databases()
+        powerpill.export_bundle(pargs['powerpill_export'], base=pargs['powerpill_export_base'])
+        return 0
+
     if not pargs['sync']:
         if pargs['files'] and pargs['refresh'] > 0:
             powerpill.refresh_databases(files=True)